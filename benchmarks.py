@@ -0,0 +1,130 @@
+'''
+Benchmarks for Flask-DBMigrate
+
+Generates a synthetic model of the given number of tables and a migration
+history of the given length on a SQLite file, times init, schemamigrate,
+migration listing, upgrade and downgrade, and prints results as JSON::
+
+    python benchmarks.py --tables 1000 --migrations 500 --output results.json
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import optparse
+import platform
+import tempfile
+
+from flask import Flask
+from flask.ext.sqlalchemy import SQLAlchemy
+
+import sqlalchemy
+from sqlalchemy import Column, Integer, String, Table
+
+from flask_dbmigrate import DBMigrate
+
+
+class _Quiet(object):
+    '''Swallow output of the measured commands'''
+
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *exc_info):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def _timed(func, *args, **kwargs):
+    start = time.time()
+    with _Quiet():
+        func(*args, **kwargs)
+    return time.time() - start
+
+
+def _summary(timings):
+    return {
+        'count': len(timings),
+        'total': sum(timings),
+        'mean': sum(timings) / len(timings) if timings else 0.0,
+        'max': max(timings) if timings else 0.0,
+    }
+
+
+def create_app(path, tables):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(
+        path, 'benchmark.db')
+    app.config['SQLALCHEMY_MIGRATE_REPO'] = os.path.join(path, 'migrations')
+    app.db = SQLAlchemy(app)
+    for i in range(tables):
+        Table('table_{0:05d}'.format(i), app.db.metadata,
+            Column('id', Integer, primary_key=True),
+            Column('name', String(100)))
+    return app
+
+
+def run(tables, migrations, path):
+    app = create_app(path, tables)
+    dbmigrate = DBMigrate(app)
+    results = {}
+
+    results['init'] = _timed(dbmigrate.init)
+
+    # each migration adds a column to the next table in turn
+    timings = []
+    for i in range(migrations):
+        table = app.db.metadata.tables['table_{0:05d}'.format(i % tables)]
+        table.append_column(Column('column_{0:05d}'.format(i), Integer))
+        timings.append(_timed(dbmigrate.schemamigrate,
+            migration_name='column_{0:05d}'.format(i)))
+    results['schemamigrate'] = _summary(timings)
+
+    results['show'] = _timed(dbmigrate.migrate, False, None, show=True)
+    results['upgrade'] = _timed(dbmigrate.migrate, True, None)
+    head = dbmigrate._get_db_version()
+
+    # reflect the whole database once to diff against it
+    table = app.db.metadata.tables['table_00000']
+    table.append_column(Column('reflected', Integer))
+    results['schemamigrate_reflect'] = _timed(dbmigrate.schemamigrate,
+        reflect=True, stdout=True)
+
+    results['downgrade'] = _timed(dbmigrate.migrate, False, 1)
+
+    return {
+        'tables': tables,
+        'migrations': migrations,
+        'python': platform.python_version(),
+        'sqlalchemy': sqlalchemy.__version__,
+        'head': head,
+        'results': results,
+    }
+
+
+def main():
+    parser = optparse.OptionParser(description='Benchmark Flask-DBMigrate')
+    parser.add_option('--tables', type='int', default=100)
+    parser.add_option('--migrations', type='int', default=50)
+    parser.add_option('--output', '-o', default='-',
+        help='file to save results to (stdout by default)')
+    args, _ = parser.parse_args()
+
+    path = tempfile.mkdtemp(prefix='dbmigrate-benchmark-')
+    try:
+        report = run(args.tables, args.migrations, path)
+    finally:
+        shutil.rmtree(path)
+
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if args.output == '-':
+        print(data)
+    else:
+        with open(args.output, 'wt') as f:
+            f.write(data)
+
+
+if __name__ == '__main__':
+    main()
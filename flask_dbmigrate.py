@@ -1,26 +1,1156 @@
 import re
 import os
+import sys
+import json
+import zlib
+import time
+import shutil
+import socket
+import hashlib
+import inspect
+import ConfigParser
+import threading
 from shutil import rmtree
+from contextlib import closing, contextmanager
 
 from flask import current_app
-from flask.ext.sqlalchemy import SQLAlchemy
 from flask.ext.script import Manager, Command, Option
 
-from sqlalchemy import schema
+from sqlalchemy import schema, text, and_, select, create_engine, event
+from sqlalchemy import types as sqltypes
+from sqlalchemy.exc import DBAPIError, IntegrityError, OperationalError
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.engine.reflection import Inspector
 
-from migrate.versioning import api, schemadiff
-from migrate.exceptions import InvalidRepositoryError
+# sqlalchemy-migrate, Flask-SQLAlchemy and multiprocessing are imported
+# where they are used, so that importing the module and constructing
+# DBMigrate stay cheap for commands which never touch them
 
 
-def with_version_control(command):
+SNAPSHOT_EXTENSION = '.json'
+INDEX_FILENAME = 'index.json'
+SCRIPT_FILENAME = re.compile('^(?P<version>[0-9]+)_.+\.py$')
+VERSION_HEADER = re.compile('^# __VERSION__: (?P<version>\d+)\n')
+REFLECT_WORKERS = 4
+TRANSACTIONAL_DDL = ('sqlite', 'postgresql')
+BACKFILL_TABLE = 'migrate_backfill'
+LOCK_TABLE = 'migrate_lock'
+SERVICE_TABLES = ('migrate_version', BACKFILL_TABLE, LOCK_TABLE)
+BACKFILL_BATCH_SIZE = 1000
+SHADOW_PREFIX = '_'
+TEMPLATE_SUFFIX = '_template'
+PROFILE_TOP = 10
+LOCK_SAMPLE_INTERVAL = 0.01
+BIND_WORKERS = 4
+FLEET_WORKERS = 4
+JOURNAL_EXTENSION = '.done'
+LOCK_NAME = 'flask_dbmigrate'
+LOCK_WAIT = 'wait'
+LOCK_SKIP = 'skip'
+LOCK_POLL_INTERVAL = 1
+LOCK_EXPIRE = 3600
+LOCK_REFRESH_INTERVAL = 60
+PLAN_BUDGET = 10
+LOCK_RETRIES = 3
+LOCK_RETRY_DELAY = 1
+# rows per second processed by index builds and table rewrites
+PLAN_RATES = {'index': 500000, 'rewrite': 100000}
+
+_ONLINE_HELPERS = re.compile(r'\b(create_index_online|drop_index_online|'
+    r'alter_table_online|backfill)\s*\(')
+
+_SCRIPTS_LOCK = threading.Lock()
+_COALESCERS = {}
+_COALESCERS_LOCK = threading.Lock()
+
+
+# (attribute, default) of types passed only in their keyword arguments
+_TYPE_KEYWORDS = (
+    (sqltypes.SchemaType, (('name', None), ('schema', None),
+        ('quote', None))),
+    (sqltypes.Enum, (('native_enum', True),)),
+)
+
+
+def _dump_type(type_):
+    '''Return serializable representation of column type'''
+    if isinstance(type_, sqltypes.TypeDecorator):
+        type_ = type_.impl
+    cls = sqltypes.NullType
+    for base in type_.__class__.__mro__:
+        if base.__module__ == 'sqlalchemy.types':
+            cls = base
+            break
+    data = {'name': cls.__name__}
+    if type_.__class__ is not cls:
+        # dialect and custom types, e.g. UUID or INET are both TypeEngine
+        data['type'] = '{0}.{1}'.format(type_.__class__.__module__,
+            type_.__class__.__name__)
+    # arguments of the dialect type constructors and of the generic type,
+    # dialect types pass most of them on as keyword arguments
+    bases = type_.__class__.__mro__
+    inits = [base.__init__ for base in bases[:bases.index(cls)]
+        if '__init__' in base.__dict__] + [cls.__init__]
+    args = {}
+    seen = set()
+    varargs = None
+    for init in inits:
+        try:
+            spec = inspect.getargspec(init)
+        except TypeError:
+            continue
+        defaults = dict(zip(reversed(spec.args),
+            reversed(spec.defaults or ())))
+        for arg in spec.args[1:]:
+            if arg.startswith('_') or arg in seen:
+                continue
+            seen.add(arg)
+            value = getattr(type_, arg, None)
+            if isinstance(value, sqltypes.TypeEngine):
+                args[arg] = _dump_type(value)
+            elif isinstance(value, (basestring, bool, int, long, float)):
+                if value != defaults.get(arg):
+                    args[arg] = value
+            elif value is not None:
+                args[arg] = {'repr': repr(value)}
+                data['lossy'] = True
+        if varargs is None and spec.varargs:
+            varargs = spec.varargs
+    for base, keywords in _TYPE_KEYWORDS:
+        if isinstance(type_, base):
+            for arg, default in keywords:
+                value = getattr(type_, arg, None)
+                if value != default:
+                    args[arg] = value
+    if args:
+        data['args'] = args
+    if varargs and getattr(type_, varargs, None):
+        data['varargs'] = list(getattr(type_, varargs))
+    return data
+
+
+def _load_type(data):
+    cls = getattr(sqltypes, data['name'], sqltypes.NullType)
+    if 'type' in data:
+        module, name = data['type'].rsplit('.', 1)
+        try:
+            cls = getattr(__import__(module, {}, {}, [name]), name)
+        except (ImportError, AttributeError):
+            pass
+    kwargs = {}
+    for key, value in data.get('args', {}).items():
+        if isinstance(value, dict):
+            if 'name' not in value:
+                # represented by repr only
+                continue
+            value = _load_type(value)
+        kwargs[str(key)] = value
+    try:
+        return cls(*data.get('varargs', []), **kwargs)
+    except TypeError:
+        # generic type in place of unavailable dialect type
+        return cls()
+
+
+def _is_lossless(metadata):
+    '''Check if dump_metadata represents all the column types'''
+    for table in metadata.tables.values():
+        for column in table.columns:
+            if 'lossy' in _dump_type(column.type):
+                return False
+    return True
+
+
+def _dump_column(column):
+    data = {
+        'name': column.name,
+        'type': _dump_type(column.type),
+        'nullable': column.nullable,
+    }
+    if column.key != column.name:
+        data['key'] = column.key
+    if column.primary_key:
+        data['primary_key'] = True
+    if column.default is not None and column.default.is_scalar:
+        arg = column.default.arg
+        if isinstance(arg, (basestring, bool, int, long, float)):
+            data['default'] = arg
+        else:
+            data['default'] = {'repr': repr(arg)}
+    if column.server_default is not None:
+        arg = getattr(column.server_default, 'arg', None)
+        if isinstance(arg, basestring):
+            data['server_default'] = arg
+        elif arg is not None:
+            data['server_default'] = {'text': str(arg)}
+    return data
+
+
+def _dump_index(index):
+    from sqlalchemy.sql import util as sql_util
+    data = {
+        'name': index.name,
+        'columns': [c.name for c in index.columns],
+        'unique': bool(index.unique),
+    }
+    where = index.kwargs.get('postgresql_where')
+    if where is not None:
+        # partial index condition without table names, as in the DDL
+        data['where'] = str(sql_util.expression_as_ddl(where))
+    if index.info.get('advisory'):
+        data['advisory'] = True
+    return data
+
+
+def _dump_table(table):
+    data = {
+        'name': table.name,
+        'columns': [_dump_column(c) for c in table.columns],
+        'foreign_keys': [],
+        'unique_constraints': [],
+        'indexes': [],
+    }
+    if table.schema:
+        data['schema'] = table.schema
+    for constraint in table.constraints:
+        if isinstance(constraint, schema.ForeignKeyConstraint):
+            data['foreign_keys'].append({
+                'name': constraint.name,
+                'columns': [fk.parent.name for fk in constraint.elements],
+                'references': [fk.target_fullname
+                    for fk in constraint.elements],
+                'ondelete': constraint.ondelete,
+                'onupdate': constraint.onupdate,
+            })
+        elif isinstance(constraint, schema.UniqueConstraint):
+            data['unique_constraints'].append({
+                'name': constraint.name,
+                'columns': [c.name for c in constraint.columns],
+            })
+    for index in table.indexes:
+        data['indexes'].append(_dump_index(index))
+    for key in ('foreign_keys', 'unique_constraints', 'indexes'):
+        data[key].sort(key=lambda item: (item['name'], item['columns']))
+    return data
+
+
+def dump_metadata(metadata):
+    '''Return serializable representation of MetaData schema'''
+    return {'tables': [_dump_table(metadata.tables[key])
+        for key in sorted(metadata.tables)]}
+
+
+def load_metadata(data):
+    '''Build MetaData from representation made by dump_metadata'''
+    metadata = schema.MetaData()
+    for table_data in data['tables']:
+        single_fks = {}
+        items = []
+        for fk in table_data['foreign_keys']:
+            if len(fk['columns']) == 1:
+                single_fks[fk['columns'][0]] = fk
+            else:
+                items.append(schema.ForeignKeyConstraint(fk['columns'],
+                    fk['references'], name=fk['name'],
+                    ondelete=fk['ondelete'], onupdate=fk['onupdate']))
+        columns = []
+        for column_data in table_data['columns']:
+            args = [column_data['name'], _load_type(column_data['type'])]
+            fk = single_fks.get(column_data['name'])
+            if fk:
+                args.append(schema.ForeignKey(fk['references'][0],
+                    name=fk['name'], ondelete=fk['ondelete'],
+                    onupdate=fk['onupdate']))
+            kwargs = {
+                'nullable': column_data['nullable'],
+                'primary_key': column_data.get('primary_key', False),
+            }
+            if 'key' in column_data:
+                kwargs['key'] = column_data['key']
+            if not isinstance(column_data.get('default', {}), dict):
+                kwargs['default'] = column_data['default']
+            server_default = column_data.get('server_default')
+            if isinstance(server_default, dict):
+                kwargs['server_default'] = text(server_default['text'])
+            elif server_default is not None:
+                kwargs['server_default'] = server_default
+            columns.append(schema.Column(*args, **kwargs))
+        for unique in table_data['unique_constraints']:
+            items.append(schema.UniqueConstraint(*unique['columns'],
+                **{'name': unique['name']}))
+        table = schema.Table(table_data['name'], metadata,
+            *(columns + items), **{'schema': table_data.get('schema')})
+        by_name = dict((c.name, c) for c in table.columns)
+        for index in table_data['indexes']:
+            kwargs = {'unique': index['unique']}
+            if index.get('where'):
+                kwargs['postgresql_where'] = text(index['where'])
+            schema.Index(index['name'],
+                *[by_name[name] for name in index['columns']], **kwargs
+                ).info['advisory'] = index.get('advisory', False)
+    return metadata
+
+
+def _get_indexes(metadata):
+    indexes = {}
+    for table in metadata.tables.values():
+        for index in table.indexes:
+            indexes[(table.schema, table.name, index.name)] = index
+    return indexes
+
+
+def _compare_index(index):
+    # index declared in the models after --add-indexes is the same index
+    data = _dump_index(index)
+    data.pop('advisory', None)
+    return data
+
+
+def diff_indexes(oldmodel, newmodel):
+    '''Return indexes added to and removed from the model, changed indexes
+    are in both lists'''
+    old = _get_indexes(oldmodel)
+    new = _get_indexes(newmodel)
+    added = []
+    removed = []
+    for key in sorted(set(old) | set(new)):
+        if key not in old:
+            added.append(new[key])
+        elif key not in new:
+            removed.append(old[key])
+        elif _compare_index(old[key]) != _compare_index(new[key]):
+            removed.append(old[key])
+            added.append(new[key])
+    return added, removed
+
+
+def _get_index_name(table, columns):
+    return 'ix_{0}_{1}'.format(table.name, '_'.join(columns))
+
+
+def advise_indexes(metadata):
+    '''Return list of (message, suggestion) about indexes of the model.
+    Suggestion is (table key, column names) of a missing index or None'''
+    advice = []
+    for key in sorted(metadata.tables):
+        table = metadata.tables[key]
+        primary_key = [c.name for c in table.primary_key.columns]
+        # column lists the database can search by
+        indexes = [(index.name, [c.name for c in index.columns],
+            bool(index.unique)) for index in sorted(table.indexes,
+                key=lambda index: index.name)]
+        covering = [columns for name, columns, unique in indexes]
+        covering.append(primary_key)
+        foreign_keys = []
+        for constraint in table.constraints:
+            if isinstance(constraint, schema.UniqueConstraint):
+                covering.append([c.name for c in constraint.columns])
+            elif isinstance(constraint, schema.ForeignKeyConstraint):
+                foreign_keys.append([fk.parent.name
+                    for fk in constraint.elements])
+        for columns in sorted(foreign_keys):
+            if not any(set(c[:len(columns)]) == set(columns)
+                for c in covering):
+                advice.append(('Foreign key {0} ({1}) has no index'.format(
+                    table.name, ', '.join(columns)), (key, columns)))
+        candidates = list(indexes)
+        if primary_key:
+            candidates.append(('primary key', primary_key, True))
+        for name, columns, unique in indexes:
+            for other, other_columns, other_unique in candidates:
+                if other == name:
+                    continue
+                if columns == other_columns:
+                    # unique one or the first by name of equal indexes
+                    # is kept
+                    if unique and not other_unique or unique == \
+                        other_unique and other != 'primary key' and \
+                        other > name:
+                        continue
+                    advice.append(('Index {0} duplicates {1} on {2} '
+                        '({3})'.format(name, other, table.name,
+                            ', '.join(columns)), None))
+                    break
+                if not unique and len(columns) < len(other_columns) and \
+                    other_columns[:len(columns)] == columns:
+                    advice.append(('Index {0} ({1}) is a prefix of {2} '
+                        '({3}) on {4}'.format(name, ', '.join(columns),
+                            other, ', '.join(other_columns), table.name),
+                        None))
+                    break
+        fk_columns = set(c for columns in foreign_keys for c in columns)
+        if len(foreign_keys) > 1 and len(primary_key) < 2 and \
+            fk_columns.issuperset(c.name for c in table.columns):
+            advice.append(('Association table {0} has no composite primary '
+                'key ({1})'.format(table.name, ', '.join(c.name
+                    for c in table.columns)), None))
+    return advice
+
+
+def _add_indexes(metadata, suggestions):
+    '''Return copy of the metadata with suggested indexes, marked as
+    advisory in snapshots'''
+    result = schema.MetaData()
+    for key in sorted(metadata.tables):
+        table = metadata.tables[key].tometadata(result)
+        advisory = set(index.name for index in metadata.tables[key].indexes
+            if index.info.get('advisory'))
+        for index in table.indexes:
+            if index.name in advisory:
+                index.info['advisory'] = True
+    for key, columns in suggestions:
+        table = result.tables[key]
+        schema.Index(_get_index_name(table, columns),
+            *[table.c[name] for name in columns]).info['advisory'] = True
+    return result
+
+
+def _keep_advisory_indexes(snapshot, metadata):
+    '''Return the metadata with indexes added by --add-indexes to the
+    snapshot, unless the models declare them or their columns are gone'''
+    suggestions = []
+    for key in sorted(snapshot.tables):
+        if key not in metadata.tables:
+            continue
+        table = metadata.tables[key]
+        declared = [[c.name for c in index.columns]
+            for index in table.indexes]
+        names = [index.name for index in table.indexes]
+        for index in sorted(snapshot.tables[key].indexes,
+            key=lambda index: index.name):
+            columns = [c.name for c in index.columns]
+            if index.info.get('advisory') and index.name not in names and \
+                columns not in declared and \
+                all(name in table.c for name in columns):
+                suggestions.append((key, columns))
+    if not suggestions:
+        return metadata
+    return _add_indexes(metadata, suggestions)
+
+
+def _render_indexes(indexes, prefix):
+    '''Return source of the metadata and list of the indexes for migration
+    script'''
+    metadata = prefix + '_index_meta'
+    tables = []
+    columns = {}
+    for index in indexes:
+        table = index.table
+        if table.key not in columns:
+            tables.append(table)
+            columns[table.key] = []
+        for column in index.columns:
+            if column.name not in columns[table.key]:
+                columns[table.key].append(column.name)
+    lines = ['{0} = MetaData()'.format(metadata)]
+    for table in tables:
+        lines.append('Table({0!r}, {1},'.format(str(table.name), metadata))
+        for name in columns[table.key]:
+            lines.append('    Column({0!r}, NullType),'.format(str(name)))
+        lines.append('    schema={0!r})'.format(table.schema))
+    lines.append('{0}_indexes = ['.format(prefix))
+    for index in indexes:
+        args = ['{0}.tables[{1!r}].c[{2!r}]'.format(metadata,
+            str(index.table.key), str(c.name)) for c in index.columns]
+        if index.unique:
+            args.append('unique=True')
+        data = _dump_index(index)
+        if 'where' in data:
+            args.append('postgresql_where=text({0!r})'.format(data['where']))
+        lines.append('    Index({0!r},'.format(str(index.name)))
+        lines.append(',\n'.join('        ' + arg for arg in args) + '),')
+    lines.append(']')
+    return '\n'.join(lines) + '\n'
+
+
+def _add_index_operations(script, added, removed, online=False):
+    '''Add creation and removal of indexes to generated migration script.
+    Indexes are removed before and created after changes of tables, in
+    both directions'''
+    if not added and not removed:
+        return script
+    create, drop = 'index.create(migrate_engine)', 'index.drop(migrate_engine)'
+    head, bodies = _split_script(script)
+    # column types do not matter for index DDL
+    head += '\nfrom sqlalchemy.types import NullType\n'
+    if online:
+        head += 'from flask_dbmigrate import create_index_online, ' \
+            'drop_index_online\n'
+        create = 'create_index_online(migrate_engine, index)'
+        drop = 'drop_index_online(migrate_engine, index)'
+    if added:
+        head += '\n' + _render_indexes(added, 'added')
+    if removed:
+        head += '\n' + _render_indexes(removed, 'removed')
+    bind = '    post_meta.bind = migrate_engine\n'
+    for i, dropped, created in ((0, removed and 'removed', added and 'added'),
+            (1, added and 'added', removed and 'removed')):
+        if dropped:
+            bodies[i] = bodies[i].replace(bind, bind + '    for index in '
+                '{0}_indexes:\n        {1}\n'.format(dropped, drop), 1)
+        if created:
+            bodies[i] += '    for index in {0}_indexes:\n' \
+                '        {1}\n'.format(created, create)
+    return head + '\n\n' + '\n\n'.join(bodies)
+
+
+def _split_script(script):
+    '''Return head and [upgrade, downgrade] bodies of migration script'''
+    upgrade = script.index('def upgrade(migrate_engine):')
+    downgrade = script.index('def downgrade(migrate_engine):')
+    return script[:upgrade].rstrip('\n') + '\n', [
+        script[upgrade:downgrade].rstrip('\n') + '\n',
+        script[downgrade:].rstrip('\n') + '\n']
+
+
+def _add_script_lines(script, imports, upgrade, downgrade):
+    '''Append lines to the end of upgrade and downgrade of generated
+    migration script'''
+    if not upgrade and not downgrade:
+        return script
+    head, bodies = _split_script(script)
+    head += '\n' + imports + '\n'
+    for i, lines in ((0, upgrade), (1, downgrade)):
+        bodies[i] += ''.join('    {0}\n'.format(line) for line in lines)
+    return head + '\n\n' + '\n\n'.join(bodies)
+
+
+def _get_expand_model(oldmodel, newmodel):
+    '''Split change of the model into expand and contract steps. Return
+    the model between them, where new tables, columns and indexes are added
+    and nothing is removed or changed yet, (table key, column name) of new
+    NOT NULL columns of existing tables, which are nullable in it, and of
+    columns which change type in the contract step'''
+    model = schema.MetaData()
+    for key in sorted(newmodel.tables):
+        newmodel.tables[key].tometadata(model)
+    for key in sorted(oldmodel.tables):
+        if key not in model.tables:
+            oldmodel.tables[key].tometadata(model)
+    constrain = []
+    changed = []
+    for key in sorted(oldmodel.tables):
+        old, table = oldmodel.tables[key], model.tables[key]
+        if key not in newmodel.tables:
+            continue
+        for column in old.columns:
+            if column.name not in table.c:
+                table.append_column(column.copy())
+            elif _dump_type(column.type) != _dump_type(
+                    table.c[column.name].type):
+                # type change rewrites the table under exclusive lock
+                table.c[column.name].type = column.type
+                changed.append((key, column.name))
+        for column in table.columns:
+            if column.name not in old.c and not column.nullable and \
+                    not column.primary_key:
+                # scripts fill client side defaults in batches instead of
+                # a single UPDATE of the whole table
+                column.nullable, column.default = True, None
+                constrain.append((key, column.name))
+    # removed and changed indexes stay as they were until contract
+    indexes = _get_indexes(model)
+    for (table_schema, table_name, name), index in sorted(
+            _get_indexes(oldmodel).items()):
+        current = indexes.get((table_schema, table_name, name))
+        if current is not None:
+            if _dump_index(current) == _dump_index(index):
+                continue
+            current.table.indexes.discard(current)
+        table = model.tables[index.table.key]
+        schema.Index(name, *[table.c[c.name] for c in index.columns],
+            **dict(index.kwargs, unique=index.unique))
+    return model, constrain, changed
+
+
+def _get_backfill_value(column):
+    '''Return value existing rows get for the new column, or None if the
+    database does not fill it'''
+    if column.server_default is not None:
+        return None
+    default = column.default
+    if default is None or not default.is_scalar:
+        return None
+    return default.arg
+
+
+def create_index_online(engine, index):
+    '''Create index without blocking writes to its table where the
+    backend can: CREATE INDEX CONCURRENTLY outside of transaction on
+    PostgreSQL, in-place build on MySQL. Intended to be used from
+    migration scripts'''
+    name = engine.dialect.name
+    if name not in ('postgresql', 'mysql'):
+        index.create(engine)
+        return
+    sql = unicode(schema.CreateIndex(index).compile(
+        dialect=engine.dialect)).strip()
+    if name == 'mysql':
+        engine.execute(sql + ' ALGORITHM=INPLACE LOCK=NONE')
+        return
+    try:
+        _execute_autocommit(engine, re.sub(r'^CREATE (UNIQUE )?INDEX',
+            r'\g<0> CONCURRENTLY', sql))
+    except Exception:
+        # failed concurrent build leaves an invalid index behind, an index
+        # of the same name that already existed is kept
+        exc_info = sys.exc_info()
+        try:
+            valid = engine.execute(text('SELECT i.indisvalid FROM pg_index i '
+                'JOIN pg_class c ON c.oid = i.indexrelid '
+                'JOIN pg_namespace n ON n.oid = c.relnamespace '
+                'WHERE c.relname = :name '
+                'AND n.nspname = COALESCE(:schema, current_schema())'),
+                name=index.name, schema=index.table.schema).scalar()
+            if valid is False:
+                _execute_autocommit(engine, _get_drop_index_online(engine,
+                    index, 'IF EXISTS '))
+        except Exception:
+            pass
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+
+def drop_index_online(engine, index):
+    '''Drop index without blocking access to its table where the backend
+    can. Intended to be used from migration scripts'''
+    name = engine.dialect.name
+    if name == 'postgresql':
+        _execute_autocommit(engine, _get_drop_index_online(engine, index))
+    elif name == 'mysql':
+        engine.execute(unicode(schema.DropIndex(index).compile(
+            dialect=engine.dialect)).strip() + ' ALGORITHM=INPLACE LOCK=NONE')
+    else:
+        index.drop(engine)
+
+
+def _get_drop_index_online(engine, index, condition=''):
+    sql = unicode(schema.DropIndex(index).compile(
+        dialect=engine.dialect)).strip()
+    return re.sub(r'^DROP INDEX ', 'DROP INDEX CONCURRENTLY ' + condition,
+        sql)
+
+
+def _execute_autocommit(engine, sql):
+    '''Execute statement outside of transaction'''
+    if not hasattr(engine, 'raw_connection'):
+        # mock engine only renders the statement
+        engine.execute(sql)
+        return
+    # raw connection skips the engine events, deferred changes of tables
+    # must be applied first
+    coalescer = _get_coalescer(engine)
+    if coalescer is not None:
+        coalescer.flush()
+    if engine.name == 'sqlite':
+        attribute, value = 'isolation_level', None
+    else:
+        attribute, value = 'autocommit', True
+    connection = engine.raw_connection()
+    try:
+        previous = getattr(connection.connection, attribute)
+        setattr(connection.connection, attribute, value)
+        try:
+            cursor = connection.cursor()
+            cursor.execute(sql)
+            cursor.close()
+        finally:
+            setattr(connection.connection, attribute, previous)
+    finally:
+        connection.close()
+
+
+def set_nullable(engine, table_name, column_name, nullable,
+                 schema_name=None):
+    '''Change nullability of the column. On PostgreSQL NOT NULL is first
+    validated as a CHECK constraint, which doesn't block writes, so the
+    ALTER doesn't scan the table under exclusive lock (PostgreSQL 12+).
+    Intended to be used from migration scripts'''
+    if engine.dialect.name != 'postgresql':
+        from migrate.changeset import alter_column
+        table = schema.Table(table_name, schema.MetaData(bind=engine),
+            schema=schema_name, autoload=True)
+        alter_column(column_name, table=table, engine=engine,
+            nullable=nullable)
+        return
+    quote = engine.dialect.identifier_preparer.quote_identifier
+    table = quote(table_name)
+    if schema_name is not None:
+        table = quote(schema_name) + '.' + table
+    column = quote(column_name)
+    if nullable:
+        engine.execute('ALTER TABLE {0} ALTER COLUMN {1} DROP NOT NULL'
+            .format(table, column))
+        return
+    check = quote('{0}_{1}_not_null'.format(table_name, column_name)[:63])
+    for sql in ('ALTER TABLE {0} ADD CONSTRAINT {2} CHECK ({1} IS NOT NULL) '
+                'NOT VALID',
+            'ALTER TABLE {0} VALIDATE CONSTRAINT {2}',
+            'ALTER TABLE {0} ALTER COLUMN {1} SET NOT NULL',
+            'ALTER TABLE {0} DROP CONSTRAINT {2}'):
+        engine.execute(sql.format(table, column, check))
+
+
+def alter_table_online(engine, table, batch_size=BACKFILL_BATCH_SIZE,
+                       sleep=0, quiet=False):
+    '''Change table to the schema of the given Table without rewriting it
+    under exclusive lock. Rows are copied into a shadow table in batches
+    paginated by primary key, while triggers copy concurrent writes, indexes
+    of the given Table are built on the shadow table, then the tables are
+    swapped in a single transaction. Columns missing from the old table
+    must be nullable or have a server default. Intended to be used from
+    migration scripts'''
+    dialect = engine.dialect.name
+    if dialect not in ('sqlite', 'postgresql', 'mysql'):
+        raise ImproperlyConfigured('Online table change is supported only '
+            'for SQLite, PostgreSQL and MySQL')
+    old = schema.Table(table.name, schema.MetaData(), schema=table.schema,
+        autoload=True, autoload_with=engine)
+    primary_key = list(old.primary_key.columns)
+    if len(primary_key) != 1 or primary_key[0].name not in table.c:
+        raise ValueError('Online table change requires table with single '
+            'column primary key')
+    # foreign keys would keep referencing the renamed old table
+    inspector = Inspector.from_engine(engine)
+    for name in inspector.get_table_names(table.schema):
+        if name == table.name:
+            continue
+        for fk in inspector.get_foreign_keys(name, table.schema):
+            if fk['referred_table'] == table.name and \
+                fk.get('referred_schema') in (None, table.schema):
+                raise ValueError('Online table change requires table not '
+                    'referenced by foreign keys, {0} references {1}'.format(
+                        name, table.name))
+    key = primary_key[0]
+    metadata = schema.MetaData()
+    shadow = schema.Table(SHADOW_PREFIX + table.name + '_new', metadata,
+        *[c.copy() for c in table.columns], **{'schema': table.schema})
+
+    preparer = engine.dialect.identifier_preparer
+    quote = preparer.quote_identifier
+    type_name = engine.dialect.type_compiler.process
+    names = [c.name for c in table.columns if c.name in old.c]
+    # templates of the copied values, formatted with the row prefix
+    values = {}
+    for name in names:
+        values[name] = '{0}' + quote(name)
+        if type_name(old.c[name].type) != type_name(table.c[name].type):
+            values[name] = 'CAST({0} AS {1})'.format(values[name],
+                type_name(table.c[name].type))
+    columns = ', '.join(quote(name) for name in names)
+    parts = {
+        'old': preparer.format_table(old),
+        'shadow': preparer.format_table(shadow),
+        'columns': columns,
+        'select': ', '.join(values[n].format('') for n in names),
+        'new': ', '.join(values[n].format('NEW.') for n in names),
+        'key': quote(key.name),
+        'trigger': quote(SHADOW_PREFIX + table.name + '_copy'),
+        'insert': quote(SHADOW_PREFIX + table.name + '_insert'),
+        'update': quote(SHADOW_PREFIX + table.name + '_update'),
+        'delete': quote(SHADOW_PREFIX + table.name + '_delete'),
+        'set': ', '.join('{0} = EXCLUDED.{0}'.format(quote(name))
+            for name in names),
+    }
+    if dialect == 'sqlite':
+        copy = 'INSERT OR IGNORE INTO {shadow} ({columns}) SELECT {select} ' \
+            'FROM {old} WHERE {key} >= :first AND {key} <= :last'
+        replace = 'INSERT OR REPLACE INTO {shadow} ({columns}) VALUES ({new})'
+        triggers = [
+            'CREATE TRIGGER {insert} AFTER INSERT ON {old} BEGIN ' +
+                replace + '; END',
+            'CREATE TRIGGER {update} AFTER UPDATE ON {old} BEGIN '
+                'DELETE FROM {shadow} WHERE {key} = OLD.{key}; ' + replace +
+                '; END',
+            'CREATE TRIGGER {delete} AFTER DELETE ON {old} BEGIN '
+                'DELETE FROM {shadow} WHERE {key} = OLD.{key}; END']
+        drop_triggers = ['DROP TRIGGER {insert}', 'DROP TRIGGER {update}',
+            'DROP TRIGGER {delete}']
+    elif dialect == 'postgresql':
+        copy = 'INSERT INTO {shadow} ({columns}) SELECT {select} FROM {old} ' \
+            'WHERE {key} >= :first AND {key} <= :last ON CONFLICT DO NOTHING'
+        triggers = [
+            'CREATE FUNCTION {trigger}() RETURNS trigger AS $$ BEGIN '
+                'IF TG_OP <> \'INSERT\' THEN DELETE FROM {shadow} '
+                'WHERE {key} = OLD.{key}; END IF; '
+                'IF TG_OP <> \'DELETE\' THEN INSERT INTO {shadow} '
+                '({columns}) VALUES ({new}) ON CONFLICT ({key}) DO UPDATE '
+                'SET {set}; END IF; RETURN NULL; END $$ LANGUAGE plpgsql',
+            'CREATE TRIGGER {trigger} AFTER INSERT OR UPDATE OR DELETE ON '
+                '{old} FOR EACH ROW EXECUTE PROCEDURE {trigger}()']
+        drop_triggers = ['DROP TRIGGER {trigger} ON {old}',
+            'DROP FUNCTION {trigger}()']
+    else:
+        copy = 'INSERT IGNORE INTO {shadow} ({columns}) SELECT {select} ' \
+            'FROM {old} WHERE {key} >= :first AND {key} <= :last'
+        replace = 'REPLACE INTO {shadow} ({columns}) VALUES ({new})'
+        triggers = [
+            'CREATE TRIGGER {insert} AFTER INSERT ON {old} '
+                'FOR EACH ROW ' + replace,
+            'CREATE TRIGGER {update} AFTER UPDATE ON {old} '
+                'FOR EACH ROW BEGIN DELETE FROM {shadow} WHERE {key} = '
+                'OLD.{key}; ' + replace + '; END',
+            'CREATE TRIGGER {delete} AFTER DELETE ON {old} '
+                'FOR EACH ROW DELETE FROM {shadow} WHERE {key} = OLD.{key}']
+        drop_triggers = ['DROP TRIGGER {insert}', 'DROP TRIGGER {update}',
+            'DROP TRIGGER {delete}']
+    # left by an interrupted change, triggers first as they write into
+    # the shadow table
+    for sql in drop_triggers:
+        engine.execute(re.sub(r'^DROP (TRIGGER|FUNCTION) ',
+            r'\g<0>IF EXISTS ', sql).format(**parts))
+    if shadow.exists(bind=engine):
+        shadow.drop(bind=engine)
+    shadow.create(bind=engine)
+    for sql in triggers:
+        engine.execute(sql.format(**parts))
+
+    start = time.time()
+    copy = text(copy.format(**parts))
+    last_key, total = None, 0
+    while True:
+        query = select([key]).order_by(key).limit(batch_size)
+        if last_key is not None:
+            query = query.where(key > last_key)
+        keys = [r[0] for r in engine.execute(query)]
+        if len(keys) == 0:
+            break
+        total += engine.execute(copy, first=keys[0], last=keys[-1]).rowcount
+        last_key = keys[-1]
+        if len(keys) < batch_size:
+            break
+        if sleep:
+            time.sleep(sleep)
+    elapsed = time.time() - start
+
+    # indexes are built before the swap, so the table is never served
+    # without them; index names are unique in the schema except on MySQL,
+    # so they get their final names in the swap
+    def qualify(name):
+        if table.schema is None:
+            return quote(name)
+        return quote(table.schema) + '.' + quote(name)
+    names = set(index.name for index in table.indexes)
+    swap_indexes = ['DROP INDEX {0}'.format(qualify(index['name']))
+        for index in inspector.get_indexes(table.name, table.schema)
+        if index['name'] in names and dialect != 'mysql']
+    for index in sorted(table.indexes, key=lambda index: index.name):
+        kwargs = dict(index.kwargs, unique=index.unique)
+        if dialect == 'sqlite':
+            # SQLite can't rename indexes, it blocks writers during the
+            # swap anyway
+            swap_indexes.append(unicode(schema.CreateIndex(index).compile(
+                dialect=engine.dialect)).strip())
+            continue
+        name = index.name
+        if dialect == 'postgresql':
+            name = SHADOW_PREFIX + index.name + '_new'
+            swap_indexes.append('ALTER INDEX {0} RENAME TO {1}'.format(
+                qualify(name), quote(index.name)))
+        create_index_online(engine, schema.Index(name,
+            *[shadow.c[c.name] for c in index.columns], **kwargs))
+
+    retired = schema.Table(SHADOW_PREFIX + table.name + '_old', metadata,
+        *[c.copy() for c in old.columns], **{'schema': table.schema})
+    rename = 'ALTER TABLE {0} RENAME TO {1}'
+    connection = engine.connect()
+    try:
+        if dialect == 'mysql':
+            # the swap is atomic, triggers move with the old table
+            connection.execute('RENAME TABLE {0} TO {1}, {2} TO {0}'.format(
+                parts['old'], preparer.format_table(retired),
+                parts['shadow']))
+            parts['old'] = preparer.format_table(retired)
+            for sql in drop_triggers:
+                connection.execute(sql.format(**parts))
+        else:
+            _swap_tables(connection, [sql.format(**parts)
+                for sql in drop_triggers] + [
+                rename.format(parts['old'], quote(retired.name)),
+                rename.format(parts['shadow'], quote(table.name))] +
+                swap_indexes, old, shadow, key.name)
+        connection.execute('DROP TABLE {0}'.format(
+            preparer.format_table(retired)))
+    finally:
+        connection.close()
+
+    if not quiet:
+        print('Copied {0} rows of {1} in {2:.3f}s ({3:.0f} rows/s)'.format(
+            total, table.name, elapsed, total / elapsed if elapsed else 0))
+    return total
+
+
+def _swap_tables(connection, statements, old, shadow, key):
+    '''Execute statements swapping old table with the shadow one in a single
+    transaction'''
+    preparer = connection.dialect.identifier_preparer
+    with _ddl_transaction(connection, 'BEGIN IMMEDIATE'):
+        if connection.dialect.name != 'sqlite':
+            connection.execute('LOCK TABLE {0} IN ACCESS EXCLUSIVE MODE'
+                .format(preparer.format_table(old)))
+            # serial column of the shadow table has its own sequence
+            connection.execute(text('SELECT setval(pg_get_serial_sequence('
+                ':table, :column), max({0})) FROM {1} HAVING max({0}) IS '
+                'NOT NULL'.format(preparer.quote_identifier(key),
+                    preparer.format_table(shadow))),
+                table=preparer.format_table(shadow), column=key)
+        for sql in statements:
+            connection.execute(sql)
+
+
+@contextmanager
+def _ddl_transaction(connection, begin='BEGIN'):
+    '''Run the block in a single transaction, DDL statements included'''
+    sqlite = connection.dialect.name == 'sqlite'
+    if sqlite:
+        # pysqlite commits implicitly before DDL statements, so the
+        # transaction has to be managed explicitly
+        dbapi_connection = connection.connection.connection
+        isolation_level = dbapi_connection.isolation_level
+        dbapi_connection.isolation_level = None
+    trans = connection.begin()
+    try:
+        if sqlite:
+            connection.execute(begin)
+        yield
+        if sqlite:
+            connection.execute('COMMIT')
+        trans.commit()
+    except:
+        if sqlite:
+            connection.execute('ROLLBACK')
+        trans.rollback()
+        raise
+    finally:
+        if sqlite:
+            dbapi_connection.isolation_level = isolation_level
+
+
+def fingerprint(metadata):
+    '''Return stable hash of tables, columns, constraints and indexes'''
+    data = dump_metadata(metadata)
+    for table in data['tables']:
+        table['columns'].sort(key=lambda column: column['name'])
+    return hashlib.sha1(json.dumps(data, sort_keys=True,
+        separators=(',', ':'))).hexdigest()
+
+
+_IDENTIFIER = r'(?:[`"]?\w+[`"]?\.)?[`"]?(?P<table>[\w$]+)[`"]?'
+_STATEMENTS = [
+    (re.compile(r'^CREATE\s+(?:UNIQUE\s+)?INDEX\s.*?\sON\s+' + _IDENTIFIER,
+        re.I | re.S), 'index'),
+    (re.compile(r'^(?:CREATE|DROP)\s+TABLE\s+' + _IDENTIFIER, re.I),
+        'metadata'),
+    (re.compile(r'^DROP\s+INDEX\s', re.I), 'metadata'),
+    (re.compile(r'^ALTER\s+TABLE\s+' + _IDENTIFIER + r'\s+(?P<action>.*)$',
+        re.I | re.S), None),
+    (re.compile(r'^INSERT\s+INTO\s+' + _IDENTIFIER + r'.*\bSELECT\b',
+        re.I | re.S), 'rewrite'),
+    (re.compile(r'^(?:UPDATE|DELETE\s+FROM)\s+' + _IDENTIFIER, re.I),
+        'rewrite'),
+    (re.compile(r'^INSERT\s+INTO\s+' + _IDENTIFIER, re.I), 'metadata'),
+]
+
+
+def _classify_alter(dialect, action):
+    action = ' '.join(action.upper().split())
+    if action.startswith('RENAME'):
+        return 'metadata'
+    if action.startswith('ADD CONSTRAINT') or action.startswith('ADD UNIQUE'):
+        # unique constraints build an index, foreign keys are validated
+        # by a scan of the table
+        return 'index' if 'UNIQUE' in action.split('(')[0] else 'rewrite'
+    if action.startswith('ADD'):
+        if dialect == 'sqlite':
+            return 'metadata'
+        if dialect == 'postgresql':
+            # before PostgreSQL 11 a default fills every row
+            return 'rewrite' if ' DEFAULT ' in action + ' ' else 'metadata'
+        return 'rewrite'
+    if action.startswith('DROP CONSTRAINT') or action.startswith('DROP '
+        'DEFAULT'):
+        return 'metadata'
+    if action.startswith('DROP'):
+        return 'metadata' if dialect == 'postgresql' else 'rewrite'
+    if action.startswith('ALTER'):
+        if action.endswith('DROP NOT NULL') or 'DEFAULT' in action and \
+            ' TYPE ' not in action:
+            return 'metadata'
+        # type changes rewrite the table, SET NOT NULL scans it
+        return 'rewrite'
+    return 'rewrite'
+
+
+def _classify_statement(dialect, sql):
+    '''Return kind of the statement (metadata, index, rewrite or unknown)
+    and the table it works on'''
+    for pattern, kind in _STATEMENTS:
+        m = pattern.match(sql.strip())
+        if m:
+            table = m.groupdict().get('table')
+            if kind is None:
+                kind = _classify_alter(dialect, m.group('action'))
+            return kind, table
+    return 'unknown', None
+
+
+def _get_lock_table(engine):
+    metadata = schema.MetaData()
+    table = schema.Table(LOCK_TABLE, metadata,
+        schema.Column('name', sqltypes.String(250), primary_key=True),
+        schema.Column('holder', sqltypes.String(250)),
+        schema.Column('acquired', sqltypes.Integer))
+    try:
+        table.create(bind=engine, checkfirst=True)
+    except DBAPIError:
+        # another node created it between the check and CREATE TABLE
+        if not table.exists(bind=engine):
+            raise
+    return table
+
+
+def _get_backfill_table(engine):
+    metadata = schema.MetaData()
+    table = schema.Table(BACKFILL_TABLE, metadata,
+        schema.Column('name', sqltypes.String(250), primary_key=True),
+        schema.Column('last_key', sqltypes.Text),
+        schema.Column('rows', sqltypes.Integer))
+    table.create(bind=engine, checkfirst=True)
+    return table
+
+
+def backfill(engine, table, values, where=None,
+                batch_size=BACKFILL_BATCH_SIZE, sleep=0, rows_per_second=None,
+                name=None, quiet=False):
+    '''Update rows of the table in batches paginated by primary key
+
+    Intended to be used from migration scripts. ``values`` is a dict of
+    column values for UPDATE or a callable ``values(connection, first_key,
+    last_key)`` returning number of processed rows. Each batch runs in its
+    own transaction and saves its last key into the checkpoint table, so
+    interrupted backfill resumes where it stopped.
+    '''
+    primary_key = list(table.primary_key.columns)
+    if len(primary_key) != 1:
+        raise ValueError('Backfill requires table with single column '
+            'primary key')
+    if not hasattr(engine, 'raw_connection'):
+        # mock engine only renders the statement
+        if not callable(values):
+            query = table.update().values(values)
+            if where is not None:
+                query = query.where(where)
+            engine.execute(query)
+        return 0
+    key = primary_key[0]
+    name = name or table.name
+    checkpoints = _get_backfill_table(engine)
+    row = engine.execute(checkpoints.select(
+        checkpoints.c.name == name)).fetchone()
+    if row is not None:
+        last_key, total = json.loads(row['last_key']), row['rows']
+    else:
+        last_key, total = None, 0
+    batch = 0
+    while True:
+        start = time.time()
+        connection = engine.connect()
+        try:
+            query = select([key]).order_by(key).limit(batch_size)
+            if last_key is not None:
+                query = query.where(key > last_key)
+            if where is not None:
+                query = query.where(where)
+            keys = [r[0] for r in connection.execute(query)]
+            if len(keys) == 0:
+                break
+            trans = connection.begin()
+            try:
+                if callable(values):
+                    rows = values(connection, keys[0], keys[-1]) or 0
+                else:
+                    condition = and_(key >= keys[0], key <= keys[-1])
+                    if where is not None:
+                        condition = and_(condition, where)
+                    rows = connection.execute(table.update().where(
+                        condition).values(values)).rowcount
+                last_key, total = keys[-1], total + rows
+                checkpoint = {'last_key': json.dumps(last_key),
+                    'rows': total}
+                if connection.execute(checkpoints.update().where(
+                    checkpoints.c.name == name).values(checkpoint)
+                    ).rowcount == 0:
+                    checkpoint['name'] = name
+                    connection.execute(checkpoints.insert().values(
+                        checkpoint))
+                trans.commit()
+            except:
+                trans.rollback()
+                raise
+        finally:
+            connection.close()
+        batch += 1
+        elapsed = time.time() - start
+        if rows_per_second and elapsed < float(rows) / rows_per_second:
+            time.sleep(float(rows) / rows_per_second - elapsed)
+        if not quiet:
+            print('Backfill {0}: batch {1}, {2} rows in {3:.3f}s '
+                '({4:.0f} rows/s)'.format(name, batch, rows, elapsed,
+                    rows / elapsed if elapsed else 0))
+        if len(keys) < batch_size:
+            break
+        if sleep:
+            time.sleep(sleep)
+    engine.execute(checkpoints.delete(checkpoints.c.name == name))
+    return total
+
+
+def with_template_database(test_method):
+    '''Run test on a fresh copy of the migrated template database instead
+    of running init, upgrade and drop. Expects ``self.dbmigrate``.'''
+    def wrapper(self, *args, **kwargs):
+        self.dbmigrate.clone_template()
+        return test_method(self, *args, **kwargs)
+    return wrapper
+
+
+def command_cache(command):
+    '''Cache database version and repository for the command lifetime'''
+    def wrapper(self, *args, **kwargs):
+        if self._cache is not None:
+            return command(self, *args, **kwargs)
+        self._cache = {}
+        try:
+            return command(self, *args, **kwargs)
+        finally:
+            self._cache = None
+    return wrapper
+
+
+def with_repository(command):
+    @command_cache
     def wrapper(self, *args, **kwargs):
+        from migrate.exceptions import InvalidRepositoryError
         try:
-            api.db_version(self.sqlalchemy_database_uri,
-                self.sqlalchemy_migration_path)
+            self._get_repository()
         except InvalidRepositoryError:
             print('You have no database under version control. '
                 'Try to "init" it first')
             return
+        return command(self, *args, **kwargs)
+    return wrapper
+
+
+def with_version_control(command):
+    @command_cache
+    def wrapper(self, *args, **kwargs):
+        from migrate.exceptions import InvalidRepositoryError
+        from migrate.exceptions import DatabaseNotControlledError
+        try:
+            self._get_db_version()
+        except (InvalidRepositoryError, DatabaseNotControlledError):
+            print('You have no database under version control. '
+                'Try to "init" it first')
+            return
         command(self, *args, **kwargs)
     return wrapper
 
@@ -29,15 +1159,512 @@ class ImproperlyConfigured(Exception):
     pass
 
 
+class LockTimeout(Exception):
+    pass
+
+
+class MigrationError(Exception):
+    pass
+
+
+class _MigrationLock(object):
+    '''Database-wide lock held while migrating: advisory lock on PostgreSQL
+    and MySQL, row in the lock table on other backends'''
+
+    def __init__(self, engine, name=LOCK_NAME,
+                 refresh_interval=LOCK_REFRESH_INTERVAL):
+        self.engine = engine
+        self.name = name
+        self.holder = '{0}:{1}'.format(socket.gethostname(), os.getpid())
+        self.connection = None
+        self.refresh_interval = refresh_interval
+        self.refresher = None
+        self.stopped = threading.Event()
+
+    def _try_acquire(self):
+        if self.engine.name == 'postgresql':
+            return self.connection.scalar(
+                text('SELECT pg_try_advisory_lock(:key)'), key=self.key)
+        elif self.engine.name == 'mysql':
+            return self.connection.scalar(
+                text('SELECT GET_LOCK(:name, 0)'), name=self.name) == 1
+        now = int(time.time())
+        try:
+            self.connection.execute(self.table.insert(), name=self.name,
+                holder=self.holder, acquired=now)
+            return True
+        except (IntegrityError, OperationalError):
+            # lock of a node which died while migrating expires
+            self.connection.execute(self.table.delete().where(and_(
+                self.table.c.name == self.name,
+                self.table.c.acquired < now - LOCK_EXPIRE)))
+            return False
+
+    def acquire(self, wait=True, timeout=None):
+        '''Take the lock, polling while it is held by another node.
+        Return False if it is held and wait is False'''
+        self.connection = self.engine.connect()
+        # lock is per schema (PostgreSQL) or database (MySQL)
+        if self.engine.name == 'postgresql':
+            self.key = zlib.crc32('{0}:{1}'.format(self.name,
+                self.connection.scalar('SELECT current_schema()'))
+                ) & 0x7fffffff
+        elif self.engine.name == 'mysql':
+            self.name = '{0}:{1}'.format(self.name,
+                self.connection.scalar('SELECT DATABASE()'))[:64]
+        else:
+            self.table = _get_lock_table(self.connection)
+        start = time.time()
+        waiting = False
+        while not self._try_acquire():
+            if not wait:
+                self.connection.close()
+                return False
+            if timeout is not None and time.time() - start >= timeout:
+                self.connection.close()
+                raise LockTimeout('Migration lock was not released in '
+                    '{0}s'.format(timeout))
+            if not waiting:
+                print('Waiting for another node to finish migration')
+                waiting = True
+            time.sleep(LOCK_POLL_INTERVAL)
+        if self.engine.name not in ('postgresql', 'mysql'):
+            # lock row of a long migration must not expire
+            self.refresher = threading.Thread(target=self._refresh)
+            self.refresher.daemon = True
+            self.refresher.start()
+        return True
+
+    def _refresh(self):
+        while True:
+            self.stopped.wait(self.refresh_interval)
+            if self.stopped.is_set():
+                return
+            try:
+                self.engine.execute(self.table.update().where(and_(
+                    self.table.c.name == self.name,
+                    self.table.c.holder == self.holder)).values(
+                        acquired=int(time.time())))
+            except DBAPIError:
+                # database is locked by the migration, and so is the row
+                pass
+
+    def release(self):
+        if self.refresher is not None:
+            self.stopped.set()
+            self.refresher.join()
+            self.refresher = None
+            self.stopped.clear()
+        try:
+            if self.engine.name == 'postgresql':
+                self.connection.execute(
+                    text('SELECT pg_advisory_unlock(:key)'), key=self.key)
+            elif self.engine.name == 'mysql':
+                self.connection.execute(
+                    text('SELECT RELEASE_LOCK(:name)'), name=self.name)
+            else:
+                self.connection.execute(self.table.delete().where(and_(
+                    self.table.c.name == self.name,
+                    self.table.c.holder == self.holder)))
+        finally:
+            self.connection.close()
+
+
+class _ConnectionEngine(object):
+    '''Engine stand-in that runs everything on a single connection, so
+    that migration scripts take part in one transaction'''
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self.connection.engine, name)
+
+    def connect(self, **kwargs):
+        return self
+
+    contextual_connect = connect
+
+    def close(self):
+        pass
+
+    def begin(self):
+        return self.connection.begin()
+
+    def execute(self, object, *multiparams, **params):
+        return self.connection.execute(object, *multiparams, **params)
+
+    def scalar(self, object, *multiparams, **params):
+        return self.connection.scalar(object, *multiparams, **params)
+
+    def run_callable(self, callable_, *args, **kwargs):
+        return self.connection.run_callable(callable_, *args, **kwargs)
+
+    def _run_visitor(self, visitorcallable, element, connection=None,
+                        **kwargs):
+        self.connection._run_visitor(visitorcallable, element, **kwargs)
+
+    def _execute_default(self, default):
+        return self.connection._execute_default(default, (), {})
+
+
+_ALTER_TABLE = re.compile(r'^ALTER TABLE ((?:"[^"]*"|`[^`]*`|[^\s"`])+) '
+    r'(?!RENAME\b)(.+)$', re.S | re.I)
+_ALTER_COLUMN = re.compile(r'(?:ADD|DROP|ALTER|CHANGE|MODIFY)(?: COLUMN)? '
+    r'(?!CONSTRAINT\b)(\S+)', re.I)
+
+
+class _Coalescer(object):
+    '''Defers changes of tables made by sqlalchemy-migrate until anything
+    else is executed, so consecutive changes of a table are applied at once:
+    with a single rebuild of the table on SQLite and a single ALTER TABLE
+    statement elsewhere'''
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.rebuild = None
+        self.alters = []
+        self.flushing = False
+
+    def defer_rebuild(self, visitor, table, column=None, delta=None):
+        from migrate.changeset.databases import sqlite
+        if self.rebuild is not None and self.rebuild[0] is not table:
+            self.flush()
+        if self.rebuild is None:
+            # table, new names of renamed columns and columns without data
+            self.rebuild = (table, {}, set())
+        renames, skipped = self.rebuild[1:]
+        if isinstance(visitor, (sqlite.SQLiteColumnGenerator,
+                sqlite.SQLiteColumnDropper)):
+            renames.pop(column.name, None)
+            skipped.add(column.name)
+        elif delta is not None and hasattr(delta, 'current_name'):
+            name, current = delta.result_column.name, delta.current_name
+            if name != current:
+                if current in skipped:
+                    skipped.add(name)
+                else:
+                    renames[name] = renames.pop(current, current)
+
+    def defer_alter(self, sql):
+        match = _ALTER_TABLE.match(sql.strip())
+        if match is None:
+            return False
+        self.alters.append(match.groups())
+        return True
+
+    def before_execute(self, conn, clauseelement, multiparams, params):
+        self.flush()
+        return clauseelement, multiparams, params
+
+    def flush(self):
+        if self.flushing or (self.rebuild is None and not self.alters):
+            return
+        self.flushing = True
+        try:
+            # connection of the statement being executed may close itself
+            # with its result
+            with closing(self.engine.connect()) as connection:
+                self._flush(connection)
+        finally:
+            self.flushing = False
+
+    def _flush(self, connection):
+        alters, self.alters = self.alters, []
+        merged = []
+        for table, clause in alters:
+            # clauses of a statement are checked against the table as it
+            # was, so a column changed again starts the next statement
+            match = _ALTER_COLUMN.match(clause)
+            column = match and match.group(1)
+            if merged and merged[-1][0] == table and (column is None or
+                    column not in merged[-1][2]):
+                merged[-1][1].append(clause)
+            else:
+                merged.append((table, [clause], set()))
+            merged[-1][2].add(column)
+        for table, clauses, columns in merged:
+            connection.execute('ALTER TABLE {0} {1}'.format(table,
+                ', '.join(clauses)))
+        if self.rebuild is not None:
+            rebuild, self.rebuild = self.rebuild, None
+            self._rebuild(connection, *rebuild)
+
+    def _rebuild(self, connection, table, renames, skipped):
+        '''Recreate SQLite table with its final schema and copy the rows
+        once, keeping indexes of the columns left intact'''
+        preparer = connection.dialect.identifier_preparer
+        quote = preparer.quote_identifier
+        name = preparer.format_table(table)
+        existing = set(row[1] for row in connection.execute(
+            'PRAGMA table_info({0})'.format(quote(table.name))))
+        targets, sources = [], []
+        for column in table.columns:
+            source = renames.get(column.name, column.name)
+            if column.name not in skipped and source in existing:
+                targets.append(quote(column.name))
+                sources.append(quote(source))
+        indexes = []
+        for index_name, sql in connection.execute(text('SELECT name, sql '
+                'FROM sqlite_master WHERE type = \'index\' AND tbl_name = '
+                ':table AND sql IS NOT NULL'), table=table.name).fetchall():
+            columns = set(row[2] for row in connection.execute(
+                'PRAGMA index_info({0})'.format(quote(index_name))))
+            if index_name not in [i.name for i in table.indexes] and \
+                    columns <= set(c.name for c in table.columns) and \
+                    not columns & (skipped | set(renames)):
+                indexes.append(sql)
+            connection.execute('DROP INDEX {0}'.format(quote(index_name)))
+        connection.execute('ALTER TABLE {0} RENAME TO migration_tmp'.format(
+            name))
+        table.create(bind=connection)
+        connection.execute('INSERT INTO {0} ({1}) SELECT {2} FROM '
+            'migration_tmp'.format(name, ', '.join(targets),
+                ', '.join(sources)))
+        connection.execute('DROP TABLE migration_tmp')
+        for sql in indexes:
+            connection.execute(sql)
+
+
+def _get_coalescer(connection):
+    return _COALESCERS.get(getattr(connection, 'engine', None))
+
+
+def _patch_changeset():
+    '''Route table changes of sqlalchemy-migrate through coalescers of
+    their engines'''
+    from migrate.changeset import ansisql
+    from migrate.changeset.schema import ChangesetColumn
+    from migrate.changeset.databases import sqlite
+    if hasattr(ansisql.AlterTableVisitor, '_dbmigrate_execute'):
+        return
+    execute = ansisql.AlterTableVisitor.execute
+    recreate_table = sqlite.SQLiteHelper.recreate_table
+    create_column = ChangesetColumn.create
+
+    def create_column_coalesced(self, table=None, *args, **kwargs):
+        # the column is added to the table before it is created, and the
+        # pending rebuild must not create it already
+        target = table if table is not None else self.table
+        coalescer = _get_coalescer(getattr(target, 'bind', None))
+        if coalescer is not None and coalescer.rebuild is not None:
+            coalescer.flush()
+        return create_column(self, table, *args, **kwargs)
+
+    def execute_coalesced(self):
+        coalescer = _get_coalescer(self.connection)
+        if coalescer is None or coalescer.engine.name == 'sqlite' or \
+                not coalescer.defer_alter(self.buffer.getvalue()):
+            return execute(self)
+        self.buffer.truncate(0)
+
+    def recreate_table_coalesced(self, table, column=None, delta=None):
+        coalescer = _get_coalescer(self.connection)
+        if coalescer is None:
+            return recreate_table(self, table, column, delta)
+        coalescer.defer_rebuild(self, table, column, delta)
+
+    ansisql.AlterTableVisitor._dbmigrate_execute = execute
+    ansisql.AlterTableVisitor.execute = execute_coalesced
+    sqlite.SQLiteHelper.recreate_table = recreate_table_coalesced
+    ChangesetColumn.create = create_column_coalesced
+
+
+@contextmanager
+def _coalesced(engine):
+    '''Coalesce changes of tables made by migration scripts on the engine'''
+    _patch_changeset()
+    coalescer = _Coalescer(engine)
+    with _COALESCERS_LOCK:
+        _COALESCERS[engine] = coalescer
+    # listeners without retval are wrapped and can't be removed
+    event.listen(engine, 'before_execute', coalescer.before_execute,
+        retval=True)
+    try:
+        yield
+        coalescer.flush()
+    finally:
+        engine.dispatch.before_execute.remove(coalescer.before_execute,
+            engine)
+        with _COALESCERS_LOCK:
+            del _COALESCERS[engine]
+
+
+# statements setting lock and statement timeouts of a connection (in
+# milliseconds or whole seconds), and restoring them
+_TIMEOUTS = {
+    'postgresql': ('SET lock_timeout = {0}', 'SET statement_timeout = {0}',
+        ['RESET lock_timeout', 'RESET statement_timeout']),
+    # max_execution_time limits SELECT statements only
+    'mysql': ('SET SESSION lock_wait_timeout = {1}', None,
+        ['SET SESSION lock_wait_timeout = DEFAULT']),
+    'sqlite': ('PRAGMA busy_timeout = {0}', None, []),
+}
+_READ_ONLY = re.compile(r'^\s*(SELECT|PRAGMA|SHOW|SET|RESET)\b', re.I)
+
+
+class _Timeouts(object):
+    '''Applies lock and statement timeouts (in seconds) to connections
+    checked out from the engine pool and tracks whether any statement
+    changed the database'''
+
+    def __init__(self, engine, lock_timeout=None, statement_timeout=None):
+        self.engine = engine
+        self.statements = []
+        self.reset = []
+        lock, statement, reset = _TIMEOUTS.get(engine.name,
+            (None, None, []))
+        for sql, timeout in ((lock, lock_timeout),
+                (statement, statement_timeout)):
+            if sql and timeout is not None:
+                self.statements.append(sql.format(int(timeout * 1000),
+                    max(1, int(timeout))))
+        if self.statements:
+            self.reset = reset
+        self.changed = False
+
+    def __enter__(self):
+        self.changed = False
+        event.listen(self.engine, 'checkout', self.checkout)
+        event.listen(self.engine, 'checkin', self.checkin)
+        event.listen(self.engine, 'after_cursor_execute', self.executed)
+        return self
+
+    def __exit__(self, *exc_info):
+        pool = self.engine.pool
+        pool.dispatch.checkout.remove(self.checkout, pool)
+        pool.dispatch.checkin.remove(self.checkin, pool)
+        self.engine.dispatch.after_cursor_execute.remove(self.executed,
+            self.engine)
+
+    def checkout(self, dbapi_connection, record, proxy):
+        if self.engine.name == 'sqlite' and self.statements:
+            cursor = dbapi_connection.cursor()
+            cursor.execute('PRAGMA busy_timeout')
+            record.info['busy_timeout'] = cursor.fetchone()[0]
+            cursor.close()
+        self._execute(dbapi_connection, self.statements)
+        record.info['timeouts'] = True
+
+    def checkin(self, dbapi_connection, record):
+        if not record.info.pop('timeouts', False):
+            return
+        if 'busy_timeout' in record.info:
+            self._execute(dbapi_connection, ['PRAGMA busy_timeout = {0}'
+                .format(record.info.pop('busy_timeout'))])
+        self._execute(dbapi_connection, self.reset)
+
+    def _execute(self, dbapi_connection, statements):
+        if not statements:
+            return
+        cursor = dbapi_connection.cursor()
+        try:
+            for sql in statements:
+                cursor.execute(sql)
+        finally:
+            cursor.close()
+
+    def executed(self, conn, cursor, statement, *args):
+        if not _READ_ONLY.match(statement):
+            self.changed = True
+
+
+def _is_lock_timeout(error):
+    '''Check if database error is a timeout waiting for a lock'''
+    orig = getattr(error, 'orig', None)
+    if getattr(orig, 'pgcode', None) == '55P03':
+        # lock_not_available
+        return True
+    args = getattr(orig, 'args', None) or [None]
+    if args[0] == 1205:
+        # MySQL lock wait timeout exceeded
+        return True
+    return 'database is locked' in str(orig)
+
+
+class _LockSampler(threading.Thread):
+    '''Measure how long a PostgreSQL backend waits for locks by polling
+    pg_locks from a separate connection'''
+
+    def __init__(self, engine, interval=LOCK_SAMPLE_INTERVAL):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.engine = engine
+        self.interval = interval
+        self.pid = None
+        self.waited = 0.0
+        self.stopped = threading.Event()
+
+    def watch(self, connection):
+        info = connection.connection.info
+        if 'pid' not in info:
+            cursor = connection.connection.cursor()
+            cursor.execute('SELECT pg_backend_pid()')
+            info['pid'] = cursor.fetchone()[0]
+            cursor.close()
+        self.waited = 0.0
+        self.pid = info['pid']
+
+    def release(self):
+        self.pid = None
+        return self.waited
+
+    def run(self):
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            while not self.stopped.is_set():
+                pid = self.pid
+                if pid is not None:
+                    cursor.execute('SELECT count(*) FROM pg_locks '
+                        'WHERE pid = %s AND NOT granted', (pid,))
+                    if cursor.fetchone()[0] and self.pid == pid:
+                        self.waited += self.interval
+                    connection.rollback()
+                self.stopped.wait(self.interval)
+        finally:
+            connection.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
 class DBMigrate(object):
 
-    def __init__(self, app):
+    def __init__(self, app, bind=None, engine=None):
         self.app = app
-        self.sqlalchemy_database_uri = self._get_db_uri()
+        self.bind = bind
+        self._engine = engine
+        if engine is not None:
+            self.sqlalchemy_database_uri = str(engine.url)
+        else:
+            self.sqlalchemy_database_uri = self._get_db_uri()
         self.sqlalchemy_migration_path = self._get_migration_path()
-        self.db = self._get_db_engine()
+        self._db = None
+        self._cache = None
+        self._head = None
+        self._version_query = None
+
+    @property
+    def db(self):
+        '''Flask-SQLAlchemy extension of the application, set up on first
+        use'''
+        if self._db is None:
+            self._db = self._get_db_engine()
+        return self._db
+
+    @db.setter
+    def db(self, db):
+        self._db = db
 
     def _get_db_uri(self):
+        if self.bind is not None:
+            binds = self.app.config.get('SQLALCHEMY_BINDS') or {}
+            if not self.bind in binds:
+                raise ImproperlyConfigured('Can not find bind "{0}" in '
+                    'SQLALCHEMY_BINDS'.format(self.bind))
+            return binds[self.bind]
         if not 'SQLALCHEMY_DATABASE_URI' in self.app.config:
             raise ImproperlyConfigured('Can not find '
                 'SQLALCHEMY_DATABASE_URI in application configuration')
@@ -48,10 +1675,16 @@ class DBMigrate(object):
         if not 'SQLALCHEMY_MIGRATE_REPO' in self.app.config:
             raise ImproperlyConfigured('Can not find '
                 'SQLALCHEMY_MIGRATE_REPO in application configuration')
-        else:
-            return self.app.config['SQLALCHEMY_MIGRATE_REPO']
+        path = self.app.config['SQLALCHEMY_MIGRATE_REPO']
+        if self.bind is None:
+            return path
+        # every bind has its own repository, next to the default one
+        repos = self.app.config.get('SQLALCHEMY_MIGRATE_REPOS') or {}
+        return repos.get(self.bind) or '{0}_{1}'.format(
+            path.rstrip(os.sep), self.bind)
 
     def _get_db_engine(self):
+        from flask.ext.sqlalchemy import SQLAlchemy
         try:
             db = self.app.db
             if not isinstance(db, SQLAlchemy):
@@ -62,57 +1695,242 @@ class DBMigrate(object):
         except AttributeError:
             return SQLAlchemy(self.app)
 
+    @property
+    def engine(self):
+        '''Engine of the application bind, shared by all migrate calls'''
+        if self._engine is not None:
+            return self._engine
+        return self.db.get_engine(self.db.get_app(), self.bind)
+
+    @property
+    def metadata(self):
+        '''Models metadata, limited to tables of the bind when the
+        application has several databases'''
+        if not self.app.config.get('SQLALCHEMY_BINDS'):
+            return self.db.metadata
+        metadata = schema.MetaData()
+        for table in self.db.get_tables_for_bind(self.bind):
+            table.tometadata(metadata)
+        return metadata
+
+    def _cached(self, key, factory):
+        if self._cache is None:
+            return factory()
+        if key not in self._cache:
+            self._cache[key] = factory()
+        return self._cache[key]
+
+    def _invalidate(self, *keys):
+        if self._cache is not None:
+            for key in keys:
+                self._cache.pop(key, None)
+
+    def _get_repository(self):
+        from migrate.versioning.repository import Repository
+        return self._cached('repository',
+            lambda: Repository(self.sqlalchemy_migration_path))
+
+    def _get_controlled_schema(self):
+        from migrate.versioning.schema import ControlledSchema
+        return self._cached('controlled_schema',
+            lambda: ControlledSchema(self.engine, self._get_repository()))
+
+    def _version_control(self, version):
+        from migrate.versioning.schema import ControlledSchema
+        ControlledSchema.create(self.engine, self._get_repository(), version)
+        self._invalidate('controlled_schema')
+
+    def _is_empty_database(self):
+        tables = set(Inspector.from_engine(self.engine).get_table_names())
+        return len(tables - set(SERVICE_TABLES)) == 0
+
+    def _create_fresh_database(self):
+        '''Create empty database from the models in a single pass and
+        stamp it at the repository head, if the head matches the models'''
+        from migrate.exceptions import DatabaseNotControlledError
+        head = self._get_schema_snapshot()
+        if head is None:
+            return False
+        model = _keep_advisory_indexes(head, self.metadata)
+        if fingerprint(head) != self.fingerprint(model):
+            return False
+        model.create_all(bind=self.engine)
+        # result must be the same as replaying the whole chain
+        if self._is_changed(self._reflect_model(), model):
+            model.drop_all(bind=self.engine)
+            return False
+        try:
+            controlled = self._get_controlled_schema()
+        except DatabaseNotControlledError:
+            self._version_control(self._get_repo_version())
+        else:
+            controlled.update_repository_table(controlled.version,
+                self._get_repo_version())
+            controlled.load()
+        return True
+
+    def _get_baseline_version(self):
+        '''Return the first version of the repository history'''
+        versions = self._get_repository().versions.versions
+        if len(versions) == 0:
+            return 1
+        return int(min(versions))
+
     def _get_db_version(self):
         '''Return current database version'''
-        return api.db_version(self.sqlalchemy_database_uri,
-            self.sqlalchemy_migration_path)
+        return self._get_controlled_schema().version
 
     def _get_repo_version(self):
         '''Return latest script version available in repo'''
-        return api.version(self.sqlalchemy_migration_path)
+        return int(self._get_repository().latest)
+
+    def fingerprint(self, model=None):
+        '''Return schema fingerprint of the model (application models
+        by default)'''
+        if model is None:
+            model = self.metadata
+        return fingerprint(model)
 
     def _is_changed(self, oldmodel, newmodel):
         '''Check if the model has been changed'''
 
+        if self.fingerprint(oldmodel) == self.fingerprint(newmodel) and \
+            _is_lossless(oldmodel) and _is_lossless(newmodel):
+            return False
+
+        from migrate.versioning import schemadiff
         diff = schemadiff.SchemaDiff(oldmodel, newmodel)
 
         if diff.tables_different:
             return True
         elif len(diff.tables_missing_from_A) > 0 or len(
-            diff.tables_missing_from_A) > 0:
+            diff.tables_missing_from_B) > 0:
             return True
         else:
-            return False
+            # SchemaDiff does not compare indexes
+            added, removed = diff_indexes(oldmodel, newmodel)
+            return len(added) > 0 or len(removed) > 0
+
+    def _get_versions_path(self):
+        return os.path.join(self.sqlalchemy_migration_path, 'versions')
+
+    def _load_script_index(self):
+        try:
+            with open(os.path.join(self._get_versions_path(),
+                INDEX_FILENAME), 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {'mtime': None, 'scripts': {}}
+
+    def _save_script_index(self, index):
+        try:
+            with open(os.path.join(self._get_versions_path(),
+                INDEX_FILENAME), 'wt') as f:
+                json.dump(index, f, sort_keys=True, separators=(',', ':'))
+        except IOError:
+            pass
+
+    def _index_script(self, script, stat):
+        with open(os.path.join(self._get_versions_path(), script), 'r') as s:
+            source = s.read()
+        m = re.match(VERSION_HEADER, source)
+        return {
+            'script': script,
+            'name': os.path.splitext(script)[0],
+            'version': int(m.group('version')) if m else None,
+            'checksum': hashlib.sha1(source).hexdigest(),
+            'mtime': stat.st_mtime,
+            'size': stat.st_size,
+        }
+
+    def _get_script_index(self):
+        '''Return index entries of migration scripts ordered by version'''
+        scripts_dir = self._get_versions_path()
+        index = self._load_script_index()
+        changed = False
+        mtime = os.stat(scripts_dir).st_mtime
+        if index['mtime'] != mtime:
+            files = [f for f in os.listdir(scripts_dir) \
+                if SCRIPT_FILENAME.search(f) and \
+                    os.path.isfile(os.path.join(scripts_dir, f))]
+            index['scripts'] = dict((f, index['scripts'].get(f))
+                for f in files)
+            # directory mtime may have coarse resolution, so do not trust
+            # it while it is too recent to notice another change
+            index['mtime'] = mtime if mtime < time.time() - 1 else None
+            changed = True
+        for script, entry in index['scripts'].items():
+            stat = os.stat(os.path.join(scripts_dir, script))
+            if entry is None or entry['mtime'] != stat.st_mtime or \
+                entry['size'] != stat.st_size:
+                index['scripts'][script] = self._index_script(script, stat)
+                changed = True
+        if changed:
+            self._save_script_index(index)
+        return sorted(index['scripts'].values(), key=lambda entry: (int(
+            SCRIPT_FILENAME.search(entry['script']).group('version')),
+            entry['script']))
+
+    def _get_head(self):
+        '''Return versions of the repository scripts, kept in memory until
+        the versions directory changes'''
+        scripts_dir = self._get_versions_path()
+        mtime = os.stat(scripts_dir).st_mtime
+        head = self._head
+        if head is not None and head[0] == mtime:
+            return head[1]
+        versions = sorted(set(int(m.group('version'))
+            for m in map(SCRIPT_FILENAME.search, os.listdir(scripts_dir))
+            if m))
+        # same as the script index, too recent mtime is not trusted
+        self._head = (mtime if mtime < time.time() - 1 else None, versions)
+        return versions
+
+    def _get_version_query(self):
+        '''Return query of the database version and its parameters, read
+        from the repository config without loading the repository'''
+        if self._version_query is None:
+            config = ConfigParser.RawConfigParser()
+            config.read(os.path.join(self.sqlalchemy_migration_path,
+                'migrate.cfg'))
+            quote = self.engine.dialect.identifier_preparer.quote_identifier
+            self._version_query = (text('SELECT version FROM {0} '
+                'WHERE repository_id = :repository_id'.format(
+                    quote(config.get('db_settings', 'version_table')))),
+                {'repository_id': config.get('db_settings', 'repository_id')})
+        return self._version_query
+
+    def _query_db_version(self):
+        query, params = self._get_version_query()
+        return self.engine.scalar(query, **params)
+
+    def pending_versions(self):
+        '''Return versions which are not applied to the database yet. Made
+        for health checks: one query by primary key on the application
+        pool and a stat of the versions directory'''
+        versions = self._get_head()
+        version = self._query_db_version()
+        if version is None:
+            return versions
+        return [v for v in versions if v > version]
+
+    def is_current(self):
+        '''Check if the database is at the latest version of the
+        repository'''
+        versions = self._get_head()
+        return self._query_db_version() == (versions[-1] if versions else 0)
 
     def _get_migration_scripts(self):
-        scripts_dir = os.path.join(self.sqlalchemy_migration_path, 'versions')
-        files = [f for f in os.listdir(scripts_dir) \
-            if os.path.isfile(os.path.join(scripts_dir, f))]
-        f = re.compile('^[0-9]+_.+\.py$')
-        scripts = sorted(filter(f.search, files))
-        return scripts
-
-    def _get_script_version(self, script):
-        with open(script, 'r') as s:
-            first_line = s.readline()
-        r = re.compile('^# __VERSION__: (?P<version>\d+)\n')
-        m = re.match(r, first_line)
-        if m:
-            return int(m.group('version'))
-        else:
-            return None
+        return [entry['script'] for entry in self._get_script_index()]
 
     def _migration_exist(self):
         '''Check if migration script already exist'''
         db_version = self._get_db_version() + 1
-        scripts = self._get_migration_scripts()
+        scripts = self._get_script_index()
         if len(scripts) == 0:
             return False
         else:
-            latest_script = os.path.join(os.path.join(
-                self.sqlalchemy_migration_path, 'versions'),
-                scripts[-1])
-            version = self._get_script_version(latest_script)
+            version = scripts[-1]['version']
             if version:
                 if version != db_version:
                     return False
@@ -122,13 +1940,43 @@ class DBMigrate(object):
                 return False
 
     def _create_migration_script(self, migration_name, oldmodel, newmodel,
-                                    stdout=False, quiet=False):
-        '''Generate migration script'''
-        version = self._get_db_version() + 1
+                                    stdout=False, quiet=False, version=None,
+                                    online=False, backfills=(), constrain=()):
+        '''Generate migration script. Online scripts build and drop indexes
+        without blocking writes, fill the given (table key, column name,
+        value) backfills and set NOT NULL on the given (table key, column
+        name) columns'''
+        from migrate.versioning.script import PythonScript
+        if version is None:
+            version = self._get_db_version() + 1
         migration = '{0}/versions/{1:03}_{2}.py'.format(
             self.sqlalchemy_migration_path, version, migration_name)
-        script = api.make_update_script_for_model(self.sqlalchemy_database_uri,
-            self.sqlalchemy_migration_path, oldmodel, newmodel)
+        script = PythonScript.make_update_script_for_model(self.engine,
+            oldmodel, newmodel, self._get_repository())
+        fill = []
+        for key, name, value in backfills:
+            # declared rather than reflected, so the script renders offline
+            table = newmodel.tables[key]
+            columns = [c.name for c in table.primary_key.columns] + [name]
+            fill.extend(['table = Table({0!r}, MetaData(),'.format(
+                str(table.name))] + ['    Column({0!r}, NullType{1}),'.format(
+                str(column), ', primary_key=True' if column != name else '')
+                for column in columns] + ['    schema={0!r})'.format(
+                table.schema), 'backfill(migrate_engine, '
+                'table, {{{0!r}: {1!r}}},\n        where=table.c[{0!r}] == '
+                'None, name={2!r})'.format(str(name), value,
+                '{0}.{1}'.format(key, name))])
+        script = _add_script_lines(script, 'from sqlalchemy.types import '
+            'NullType\nfrom flask_dbmigrate import backfill', fill, [])
+        script = _add_script_lines(script, 'from flask_dbmigrate import '
+            'set_nullable', ['set_nullable(migrate_engine, {0!r}, {1!r}, '
+            'False, {2!r})'.format(str(newmodel.tables[key].name), str(name),
+            newmodel.tables[key].schema) for key, name in constrain],
+            ['set_nullable(migrate_engine, {0!r}, {1!r}, True, {2!r})'.format(
+            str(newmodel.tables[key].name), str(name),
+            newmodel.tables[key].schema) for key, name in constrain])
+        script = _add_index_operations(script,
+            *diff_indexes(oldmodel, newmodel), **{'online': online})
         header = '# __VERSION__: {0}\n'.format(version)
         script = header + script
         if stdout:
@@ -136,91 +1984,1026 @@ class DBMigrate(object):
         else:
             with open(migration, 'wt') as f:
                 f.write(script)
+            self._write_schema_snapshot(migration, newmodel)
+            self._invalidate('repository', 'controlled_schema')
             if not quiet:
                 print('New migration saved as {0}'.format(migration))
                 print('To apply migration, run: "manage.py dbmigrate migrate"')
 
+    def _get_snapshot_path(self, script):
+        return os.path.splitext(script)[0] + SNAPSHOT_EXTENSION
+
+    def _write_schema_snapshot(self, script, model):
+        '''Save schema of the model next to the migration script'''
+        with open(self._get_snapshot_path(script), 'wt') as f:
+            json.dump(dump_metadata(model), f, sort_keys=True,
+                separators=(',', ':'))
+
+    def _get_schema_snapshot(self):
+        '''Return schema saved with the latest migration script'''
+        scripts = self._get_migration_scripts()
+        if len(scripts) == 0:
+            return schema.MetaData()
+        snapshot = self._get_snapshot_path(os.path.join(
+            self._get_versions_path(), scripts[-1]))
+        if not os.path.exists(snapshot):
+            return None
+        with open(snapshot, 'r') as f:
+            return load_metadata(json.load(f))
+
+    def _reflect_model(self):
+        '''Return schema reflected from the database'''
+        model = schema.MetaData(bind=self.engine, reflect=True)
+        for name in SERVICE_TABLES:
+            if name in model.tables:
+                model.remove(model.tables[name])
+        return model
+
+    def _get_managed_tables(self):
+        '''Return (schema, name) of tables owned by models or migrations'''
+        tables = set((t.schema, t.name)
+            for t in self.metadata.tables.values())
+        versions = self._get_versions_path()
+        for script in self._get_migration_scripts():
+            snapshot = self._get_snapshot_path(os.path.join(versions, script))
+            if os.path.exists(snapshot):
+                with open(snapshot, 'r') as f:
+                    for table in json.load(f)['tables']:
+                        tables.add((table.get('schema'), table['name']))
+        for name in SERVICE_TABLES:
+            tables.discard((None, name))
+        return tables
+
+    def _reflect_table(self, table):
+        '''Reflect single table on its own pooled connection'''
+        table_schema, name = table
+        start = time.time()
+        connection = self.engine.connect()
+        try:
+            inspector = Inspector.from_engine(connection)
+            primary_keys = inspector.get_primary_keys(name, table_schema)
+            data = {'name': name, 'columns': [], 'foreign_keys': [],
+                'unique_constraints': [], 'indexes': []}
+            if table_schema:
+                data['schema'] = table_schema
+            for column in inspector.get_columns(name, table_schema):
+                column_data = {
+                    'name': column['name'],
+                    'type': _dump_type(column['type']),
+                    'nullable': column['nullable'],
+                }
+                if column['name'] in primary_keys:
+                    column_data['primary_key'] = True
+                if column.get('default') is not None:
+                    column_data['server_default'] = {
+                        'text': column['default']}
+                data['columns'].append(column_data)
+            for fk in inspector.get_foreign_keys(name, table_schema):
+                referred = fk['referred_table']
+                if fk.get('referred_schema'):
+                    referred = fk['referred_schema'] + '.' + referred
+                data['foreign_keys'].append({
+                    'name': fk.get('name'),
+                    'columns': fk['constrained_columns'],
+                    'references': [referred + '.' + c
+                        for c in fk['referred_columns']],
+                    'ondelete': None,
+                    'onupdate': None,
+                })
+            for index in inspector.get_indexes(name, table_schema):
+                data['indexes'].append({
+                    'name': index['name'],
+                    'columns': index['column_names'],
+                    'unique': bool(index['unique']),
+                })
+        finally:
+            connection.close()
+        return data, time.time() - start
+
+    def _reflect_scoped_model(self, workers=None, quiet=False):
+        '''Return schema of managed tables reflected in parallel'''
+        from multiprocessing.pool import ThreadPool
+        inspector = Inspector.from_engine(self.engine)
+        existing = {}
+        tables = []
+        for table in sorted(self._get_managed_tables()):
+            if table[0] not in existing:
+                existing[table[0]] = set(
+                    inspector.get_table_names(table[0]))
+            if table[1] in existing[table[0]]:
+                tables.append(table)
+        if len(tables) == 0:
+            return schema.MetaData()
+        workers = min(workers or self.app.config.get(
+            'SQLALCHEMY_MIGRATE_REFLECT_WORKERS', REFLECT_WORKERS),
+            len(tables))
+        pool = ThreadPool(workers)
+        try:
+            results = pool.map(self._reflect_table, tables)
+        finally:
+            pool.close()
+            pool.join()
+        if not quiet:
+            for data, elapsed in results:
+                print('Reflected {0} in {1:.3f}s'.format(data['name'],
+                    elapsed))
+        return load_metadata({'tables': [data for data, _ in results]})
+
+    def _get_old_model(self, reflect=False, scoped=False, workers=None,
+                        quiet=False):
+        if scoped:
+            return self._reflect_scoped_model(workers, quiet)
+        if reflect:
+            return self._reflect_model()
+        model = self._get_schema_snapshot()
+        if model is None:
+            print('Can not find schema snapshot for the latest migration. '
+                'Try to use "--reflect" option')
+        return model
+
     def _drop(self):
-        self.db.drop_all()
+        self._invalidate('repository', 'controlled_schema')
+        self.metadata.drop_all(bind=self.engine)
         if os.path.exists(self.sqlalchemy_migration_path):
             rmtree(self.sqlalchemy_migration_path)
 
     def _show_migrations(self):
         db_version = self._get_db_version()
-        scripts = self._get_migration_scripts()
+        scripts = self._get_script_index()
         if len(scripts) > 0:
             print('')
             for script in scripts:
-                script_version = self._get_script_version(
-                    os.path.join(os.path.join(self.sqlalchemy_migration_path,
-                        'versions'), script))
+                script_version = script['version']
                 if script_version:
                     if script_version < db_version:
                         print(' (*) {0} (ver. {1})'.format(
-                            script.replace('.py', ''), script_version))
+                            script['name'], script_version))
                     else:
                         print(' ( ) {0} (ver. {1})'.format(
-                            script.replace('.py', ''), script_version))
+                            script['name'], script_version))
             print('')
         else:
             print('No migrations!')
 
     def _upgrade(self, version=None):
-        if version:
-            api.upgrade(self.sqlalchemy_database_uri,
-                self.sqlalchemy_migration_path, version)
-        else:
-            api.upgrade(self.sqlalchemy_database_uri,
-                self.sqlalchemy_migration_path)
+        # ControlledSchema.upgrade applies the changeset towards the given
+        # version (latest by default) on the shared engine
+        with _coalesced(self.engine):
+            self._run_changeset(version)
 
     def _downgrade(self, version):
-        api.downgrade(self.sqlalchemy_database_uri,
-            self.sqlalchemy_migration_path, version)
+        self._run_changeset(version)
 
-    def init(self):
-        if not os.path.exists(self.sqlalchemy_migration_path):
-            api.create(self.sqlalchemy_migration_path, 'database repository')
-            api.version_control(self.sqlalchemy_database_uri,
-                self.sqlalchemy_migration_path)
+    def _run_changeset(self, version=None):
+        controlled = self._get_controlled_schema()
+        changeset = controlled.changeset(version)
+        for ver, change in changeset:
+            self._run_change(controlled, ver, change, changeset.step)
+
+    def _run_change(self, controlled, ver, change, step):
+        '''Run a version of the migration with lock and statement timeouts
+        of the script (LOCK_TIMEOUT and STATEMENT_TIMEOUT) or configured
+        ones. A version which timed out waiting for a lock before changing
+        anything is retried with exponential backoff'''
+        from migrate.versioning.script import PythonScript
+        config = self.app.config
+        lock_timeout = config.get('SQLALCHEMY_MIGRATE_DDL_LOCK_TIMEOUT')
+        statement_timeout = config.get('SQLALCHEMY_MIGRATE_STATEMENT_TIMEOUT')
+        if isinstance(change, PythonScript):
+            lock_timeout = getattr(change.module, 'LOCK_TIMEOUT',
+                lock_timeout)
+            statement_timeout = getattr(change.module, 'STATEMENT_TIMEOUT',
+                statement_timeout)
+        if lock_timeout is None and statement_timeout is None:
+            controlled.runchange(ver, change, step)
+            return
+        retries = config.get('SQLALCHEMY_MIGRATE_RETRIES', LOCK_RETRIES)
+        delay = config.get('SQLALCHEMY_MIGRATE_RETRY_DELAY', LOCK_RETRY_DELAY)
+        timeouts = _Timeouts(self.engine, lock_timeout, statement_timeout)
+        for attempt in range(1, retries + 2):
+            try:
+                with timeouts:
+                    controlled.runchange(ver, change, step)
+                return
+            except DBAPIError, e:
+                if attempt > retries or timeouts.changed or \
+                        not _is_lock_timeout(e):
+                    raise
+            print('Version {0} timed out waiting for a lock, retrying in '
+                '{1:g}s (attempt {2} of {3})'.format(int(max(ver,
+                    ver + step)), delay, attempt + 1, retries + 1))
+            # scripts mutate their module level tables when run
+            change.__dict__.pop('_module', None)
+            time.sleep(delay)
+            delay *= 2
+
+    def _migrate_batch(self, version=None):
+        '''Apply all pending versions in a single transaction'''
+        if self.engine.name not in TRANSACTIONAL_DDL:
+            raise MigrationError('Batch migration is not supported by {0} '
+                'backend, it has no transactional DDL'.format(
+                    self.engine.name))
+        controlled = self._get_controlled_schema()
+        changeset = controlled.changeset(version)
+        if len(changeset) == 0:
+            return
+        # online helpers commit on their own connections
+        for ver, change in changeset:
+            match = _ONLINE_HELPERS.search(change.source())
+            if match is not None:
+                raise MigrationError('Version {0} ({1}) uses {2}, which '
+                    'can not run in batch migration'.format(int(ver),
+                        os.path.basename(change.path), match.group(1)))
+        connection = self.engine.connect()
+        try:
+            with _ddl_transaction(connection):
+                engine = _ConnectionEngine(connection)
+                for ver, change in changeset:
+                    change.run(engine, changeset.step)
+                table = controlled.table
+                connection.execute(table.update().where(and_(
+                    table.c.version == int(changeset.start),
+                    table.c.repository_id == str(controlled.repository.id))
+                    ).values(version=int(changeset.end)))
+        finally:
+            connection.close()
+        controlled.load()
+
+    def _migrate_profiled(self, version, report, top=PROFILE_TOP):
+        '''Apply migrations recording wall time, affected rows and lock
+        wait of every statement, grouped by script version'''
+        controlled = self._get_controlled_schema()
+        changeset = controlled.changeset(version)
+        sampler = None
+        if self.engine.name == 'postgresql':
+            sampler = _LockSampler(self.engine)
+        profile = {'backend': self.engine.name, 'versions': []}
+        statements = []
+        started = []
+
+        def before(conn, cursor, statement, parameters, context, many):
+            if sampler is not None:
+                sampler.watch(conn)
+            started.append(time.time())
+            return statement, parameters
+
+        def after(conn, cursor, statement, parameters, context, many):
+            statements.append({
+                'statement': statement.strip(),
+                'elapsed': time.time() - started.pop(),
+                'rows': cursor.rowcount,
+                'lock_wait': sampler.release() if sampler else None,
+            })
+
+        event.listen(self.engine, 'before_cursor_execute', before,
+            retval=True)
+        event.listen(self.engine, 'after_cursor_execute', after)
+        if sampler is not None:
+            sampler.start()
+        start = time.time()
+        try:
+            with _coalesced(self.engine):
+                for ver, change in changeset:
+                    del statements[:]
+                    del started[:]
+                    entry = {'version': int(max(ver, ver + changeset.step)),
+                        'script': os.path.basename(change.path)}
+                    profile['versions'].append(entry)
+                    version_start = time.time()
+                    try:
+                        self._run_change(controlled, ver, change,
+                            changeset.step)
+                    finally:
+                        entry['elapsed'] = time.time() - version_start
+                        entry['statements'] = list(statements)
+        finally:
+            profile['elapsed'] = time.time() - start
+            # event.remove does not support engine targets yet
+            self.engine.dispatch.before_cursor_execute.remove(before,
+                self.engine)
+            self.engine.dispatch.after_cursor_execute.remove(after,
+                self.engine)
+            if sampler is not None:
+                sampler.stop()
+            with open(report, 'wt') as f:
+                json.dump(profile, f, indent=2)
+            self._print_profile(profile, top)
+        print('Profile saved as {0}'.format(report))
+
+    def _print_profile(self, profile, top=PROFILE_TOP):
+        for entry in profile['versions']:
+            print('{0:8.3f}s  {1}'.format(entry['elapsed'], entry['script']))
+        slowest = sorted(((s['elapsed'], entry['version'], s)
+            for entry in profile['versions'] for s in entry['statements']),
+            key=lambda item: item[0], reverse=True)[:top]
+        if slowest:
+            print('Top {0} statements:'.format(len(slowest)))
+        for elapsed, version, s in slowest:
+            lock_wait = ''
+            if s['lock_wait']:
+                lock_wait = ' lock wait {0:.3f}s'.format(s['lock_wait'])
+            print('{0:8.3f}s  v{1} rows={2}{3}  {4}'.format(elapsed, version,
+                s['rows'], lock_wait, ' '.join(s['statement'].split())[:60]))
+
+    def _get_template_url(self):
+        url = make_url(self.sqlalchemy_database_uri)
+        template = make_url(self.sqlalchemy_database_uri)
+        if url.drivername.startswith('sqlite'):
+            if url.database in (None, '', ':memory:'):
+                raise ImproperlyConfigured('Template database requires '
+                    'SQLite database file')
+            root, ext = os.path.splitext(url.database)
+            template.database = root + TEMPLATE_SUFFIX + ext
+        elif url.drivername.startswith('postgresql'):
+            template.database = url.database + TEMPLATE_SUFFIX
         else:
-            api.version_control(self.sqlalchemy_database_uri,
-                self.sqlalchemy_migration_path,
-                api.version(self.sqlalchemy_migration_path))
-        # create initial migration script
-        old_model = schema.MetaData(bind=self.db.engine, reflect=True)
-        if 'migrate_version' in old_model.tables:
-            old_model.remove(old_model.tables['migrate_version'])
-        self._create_migration_script('initial', old_model,
-            self.db.metadata, quiet=True)
+            raise ImproperlyConfigured('Template database is supported '
+                'only for SQLite and PostgreSQL')
+        return url, template
 
-    @with_version_control
-    def schemamigrate(self, migration_name=None, stdout=None):
-        old_model = schema.MetaData(bind=self.db.engine, reflect=True)
-        if 'migrate_version' in old_model.tables:
-            old_model.remove(old_model.tables['migrate_version'])
-        if not self._is_changed(old_model, self.db.metadata):
-            print('No Changes!')
+    def _execute_maintenance(self, *statements, **params):
+        '''Execute statements on PostgreSQL maintenance database, return
+        rows of the last one'''
+        url = make_url(self.sqlalchemy_database_uri)
+        url.database = 'postgres'
+        engine = create_engine(url)
+        connection = engine.raw_connection()
+        try:
+            # CREATE DATABASE can not run inside a transaction block
+            connection.connection.set_isolation_level(0)
+            cursor = connection.cursor()
+            for statement in statements:
+                cursor.execute(statement, params or None)
+            if cursor.description is not None:
+                return cursor.fetchall()
+        finally:
+            connection.close()
+            engine.dispose()
+
+    def _copy_database(self, source, target=None):
+        '''Replace target database with a copy of the source database,
+        or with an empty database if there is no target'''
+        self.engine.dispose()
+        if target is None:
+            target, source = source, None
+        if target.drivername.startswith('sqlite'):
+            if source is not None:
+                shutil.copyfile(source.database, target.database)
+            elif os.path.exists(target.database):
+                os.remove(target.database)
         else:
-            # check if migration script exists
-            if self._migration_exist():
-                print('No Changes!')
+            quote = self.engine.dialect.identifier_preparer.quote_identifier
+            create = 'CREATE DATABASE {0}'.format(quote(target.database))
+            if source is not None:
+                create += ' TEMPLATE {0}'.format(quote(source.database))
+            self._execute_maintenance('DROP DATABASE IF EXISTS {0}'.format(
+                quote(target.database)), create)
+
+    def _get_template_info(self):
+        return {'fingerprint': self.fingerprint(),
+            'version': self._get_repo_version()}
+
+    def _get_template_info_path(self, template):
+        return os.path.splitext(template.database)[0] + '.json'
+
+    def _load_template_info(self, template):
+        '''Return info saved with the template database, None if there is
+        no template database'''
+        if template.drivername.startswith('sqlite'):
+            info = self._get_template_info_path(template)
+            if not os.path.exists(template.database) or \
+                not os.path.exists(info):
+                return None
+            with open(info, 'r') as f:
+                return json.load(f)
+        # info is the comment of the template database
+        rows = self._execute_maintenance("SELECT shobj_description(oid, "
+            "'pg_database') FROM pg_database WHERE datname = %(name)s",
+            name=template.database)
+        if not rows or rows[0][0] is None:
+            return None
+        return json.loads(rows[0][0])
+
+    def _save_template_info(self, template):
+        info = json.dumps(self._get_template_info())
+        if template.drivername.startswith('sqlite'):
+            with open(self._get_template_info_path(template), 'wt') as f:
+                f.write(info)
+        else:
+            quote = self.engine.dialect.identifier_preparer.quote_identifier
+            self._execute_maintenance('COMMENT ON DATABASE {0} IS '
+                '%(info)s'.format(quote(template.database)), info=info)
+
+    def _is_template_current(self):
+        url, template = self._get_template_url()
+        info = self._load_template_info(template)
+        return info is not None and info == self._get_template_info()
+
+    def create_template(self):
+        '''Migrate the database once and save it as template database'''
+        url, template = self._get_template_url()
+        self._copy_database(url)
+        self._invalidate('controlled_schema')
+        if os.path.exists(self.sqlalchemy_migration_path):
+            self.migrate(upgrade=True, version=None)
+        else:
+            self.init()
+            self._upgrade()
+        self._copy_database(url, template)
+        self._save_template_info(template)
+
+    def clone_template(self):
+        '''Replace the database with a copy of the template database,
+        creating template first if it is missing or out of date'''
+        if not self._is_template_current():
+            self.create_template()
+        url, template = self._get_template_url()
+        self._copy_database(template, url)
+        self._invalidate('controlled_schema')
+
+    def drop_template(self):
+        url, template = self._get_template_url()
+        if url.drivername.startswith('sqlite'):
+            for path in (template.database,
+                self._get_template_info_path(template)):
+                if os.path.exists(path):
+                    os.remove(path)
+        else:
+            quote = self.engine.dialect.identifier_preparer.quote_identifier
+            self._execute_maintenance('DROP DATABASE IF EXISTS {0}'.format(
+                quote(template.database)))
+
+    def _render_changeset(self, version=None, start=None):
+        '''Return statements of every step of the migration from start
+        version (database version by default) to the given version (latest
+        by default), rendered without connecting to the database. Steps
+        are None if a script needs the database'''
+        from migrate.versioning.script import PythonScript
+        statements = []
+
+        def executor(sql, *multiparams, **params):
+            if not isinstance(sql, basestring):
+                sql = unicode(sql.compile(dialect=engine.dialect))
+            statements.append(sql.strip().rstrip(';'))
+
+        engine = create_engine(make_url(self.sqlalchemy_database_uri),
+            strategy='mock', executor=executor)
+        if start is None:
+            from migrate.exceptions import DatabaseNotControlledError
+            try:
+                start = self._get_db_version()
+            except DatabaseNotControlledError:
+                print('You have no database under version control. Try to '
+                    '"init" it first, or set the starting version with '
+                    '--from')
+                return engine, None
+        changeset = self._get_repository().changeset(engine.name, start,
+            version)
+        steps = []
+        for ver, change in changeset:
+            statements = []
+            if isinstance(change, PythonScript):
+                # scripts mutate their module level tables when run, so
+                # render from a freshly loaded module and drop it after
+                change.__dict__.pop('_module', None)
+                try:
+                    change.run(engine, changeset.step)
+                except Exception, e:
+                    # e.g. scripts reflecting tables need the database
+                    print('Version {0} ({1}) can not be rendered without '
+                        'database connection: {2}'.format(int(ver),
+                            os.path.basename(change.path), e))
+                    return engine, None
+                finally:
+                    change.__dict__.pop('_module', None)
             else:
-                # create migration
-                self._create_migration_script(migration_name, old_model,
-                    self.db.metadata, stdout)
+                statements.append(change.source().strip())
+            steps.append((int(ver), int(ver + changeset.step), change,
+                statements))
+        return engine, steps
+
+    def _render_sql(self, version=None, start=None):
+        '''Return SQL script of the migration'''
+        engine, steps = self._render_changeset(version, start)
+        if steps is None:
+            return None
+        repository = self._get_repository()
+        quote = engine.dialect.identifier_preparer.quote_identifier
+        update = 'UPDATE {0} SET version={{1}} WHERE repository_id=\'{1}\' ' \
+            'AND version={{0}};'.format(quote(repository.version_table),
+                str(repository.id).replace("'", "''"))
+        lines = []
+        if engine.name in TRANSACTIONAL_DDL:
+            lines.append('BEGIN;')
+        for ver, nextver, change, statements in steps:
+            lines.append('')
+            lines.append('-- {0} -> {1}'.format(ver, nextver))
+            lines.extend(statement + ';' for statement in statements)
+            lines.append(update.format(ver, nextver))
+        if engine.name in TRANSACTIONAL_DDL:
+            lines.append('')
+            lines.append('COMMIT;')
+        return '\n'.join(lines) + '\n'
+
+    def _get_table_stats(self, table):
+        '''Return estimated number of rows and size in bytes (None if
+        unknown) of the table'''
+        if self.engine.name == 'postgresql':
+            row = self.engine.execute(text('SELECT c.reltuples, '
+                'pg_total_relation_size(c.oid) FROM pg_class c '
+                'JOIN pg_namespace n ON n.oid = c.relnamespace '
+                'WHERE c.relname = :name AND n.nspname = current_schema()'),
+                name=table).first()
+        elif self.engine.name == 'mysql':
+            row = self.engine.execute(text('SELECT table_rows, '
+                'data_length + index_length FROM information_schema.tables '
+                'WHERE table_name = :name AND table_schema = DATABASE()'),
+                name=table).first()
+        else:
+            if table not in Inspector.from_engine(
+                self.engine).get_table_names():
+                return 0, None
+            quote = self.engine.dialect.identifier_preparer.quote_identifier
+            row = (self.engine.scalar('SELECT COUNT(*) FROM {0}'.format(
+                quote(table))), None)
+        if row is None:
+            return 0, None
+        return int(row[0] or 0), row[1] and int(row[1])
+
+    @with_repository
+    def migrate_plan(self, version=None, budget=None):
+        '''Print pending operations classified as metadata-only, index
+        builds or table rewrites, with time estimated from the live table
+        statistics. Return the plan as list of dicts, or None if it can
+        not be rendered'''
+        if budget is None:
+            budget = self.app.config.get('SQLALCHEMY_MIGRATE_PLAN_BUDGET',
+                PLAN_BUDGET)
+        rates = dict(PLAN_RATES)
+        rates.update(self.app.config.get('SQLALCHEMY_MIGRATE_PLAN_RATES', {}))
+        engine, steps = self._render_changeset(version)
+        if steps is None:
+            return None
+        stats = {}
+        plan = []
+        for ver, nextver, change, statements in steps:
+            print('{0} -> {1} ({2})'.format(ver, nextver,
+                os.path.basename(change.path)))
+            for statement in statements:
+                kind, table = _classify_statement(engine.name, statement)
+                rows, size = 0, None
+                if kind in rates and table:
+                    if table not in stats:
+                        stats[table] = self._get_table_stats(table)
+                    rows, size = stats[table]
+                seconds = float(rows) / rates[kind] if kind in rates else 0.0
+                operation = {'version': max(ver, nextver), 'kind': kind,
+                    'table': table, 'rows': rows, 'bytes': size,
+                    'seconds': seconds, 'over_budget': seconds > budget,
+                    'statement': statement}
+                plan.append(operation)
+                print('{0} {1:<9} {2:<20} {3:>12} {4:>8.1f}s  {5}'.format(
+                    '!' if operation['over_budget'] else ' ', kind,
+                    table or '', '{0} rows'.format(rows) if rows else '',
+                    seconds, ' '.join(statement.split())[:60]))
+        over = [o for o in plan if o['over_budget']]
+        print('Estimated time {0:.1f}s, {1} operation(s) over the {2}s '
+            'budget'.format(sum(o['seconds'] for o in plan), len(over),
+                budget))
+        return plan
+
+    @command_cache
+    def init(self, reflect=False):
+        from migrate.versioning import api
+        new_repository = not os.path.exists(self.sqlalchemy_migration_path)
+        if new_repository:
+            api.create(self.sqlalchemy_migration_path, 'database repository')
+        empty = self._is_empty_database()
+        if not empty:
+            self._version_control(self._get_repo_version())
+        # create initial migration script, against the live schema when
+        # the tool is adopted on an existing database
+        old_model = self._get_old_model(reflect or (not empty and
+            len(self._get_migration_scripts()) == 0))
+        if old_model is not None and (new_repository or
+            self._is_changed(old_model, self.metadata)):
+            self._create_migration_script('initial', old_model,
+                self.metadata, quiet=True,
+                version=self._get_repo_version() + 1)
+        if empty and not self._create_fresh_database():
+            self._version_control(self._get_baseline_version() - 1)
+
+    @with_repository
+    def schemamigrate(self, migration_name=None, stdout=None, reflect=False,
+                        scoped=False, workers=None, advise=False,
+                        add_indexes=False, online=False):
+        reflect = reflect or scoped
+        old_model = self._get_old_model(reflect, scoped, workers, stdout)
+        if old_model is None:
+            return
+        model = self.metadata
+        snapshot = old_model if not reflect else \
+            self._get_schema_snapshot()
+        if snapshot is not None:
+            model = _keep_advisory_indexes(snapshot, model)
+        if advise or add_indexes:
+            advice = advise_indexes(model)
+            for message, suggestion in advice:
+                print('Advice: {0}'.format(message))
+            suggestions = [s for message, s in advice if s is not None]
+            if add_indexes and suggestions:
+                model = _add_indexes(model, suggestions)
+        if not self._is_changed(old_model, model):
+            print('No Changes!')
+        elif reflect and self._migration_exist():
+            # check if migration script exists
+            print('No Changes!')
+        elif online:
+            version = None if reflect else self._get_repo_version() + 1
+            self._create_online_migration_scripts(migration_name, old_model,
+                model, stdout, version)
+        elif reflect:
+            # create migration
+            self._create_migration_script(migration_name, old_model,
+                model, stdout)
+        else:
+            self._create_migration_script(migration_name, old_model,
+                model, stdout, version=self._get_repo_version() + 1)
+
+    def _create_online_migration_scripts(self, migration_name, oldmodel,
+                                         newmodel, stdout, version=None):
+        '''Generate migration which keeps the application writable. Changes
+        the running application can't cope with (drops, new NOT NULL
+        columns and type changes) are moved into separate contract version,
+        to be applied after the application is deployed'''
+        if version is None:
+            version = self._get_db_version() + 1
+        expand, constrain, changed = _get_expand_model(oldmodel, newmodel)
+        for key, name in changed:
+            print('Column {0}.{1} changes type in version {2}, which '
+                'rewrites the table under exclusive lock; use '
+                'alter_table_online instead'.format(key, name, version + 1))
+        if not constrain and not self._is_changed(expand, newmodel):
+            self._create_migration_script(migration_name, oldmodel,
+                newmodel, stdout, version=version, online=True)
+            return
+        backfills = []
+        for key, name in constrain:
+            value = _get_backfill_value(newmodel.tables[key].c[name])
+            if value is not None:
+                backfills.append((key, name, value))
+            elif newmodel.tables[key].c[name].server_default is None:
+                print('Column {0}.{1} has no default, fill it before '
+                    'version {2}'.format(key, name, version + 1))
+        self._create_migration_script(migration_name + '_expand', oldmodel,
+            expand, stdout, version=version, online=True, backfills=backfills)
+        # rows the running application added meanwhile are filled again
+        self._create_migration_script(migration_name + '_contract', expand,
+            newmodel, stdout, version=version + 1, online=True,
+            backfills=backfills, constrain=constrain)
+
+    @contextmanager
+    def _migration_lock(self, policy=None, timeout=None):
+        '''Hold the migration lock, so only one node migrates at a time.
+        Yield False if another node holds it and the policy is to skip'''
+        if policy is None:
+            policy = self.app.config.get('SQLALCHEMY_MIGRATE_LOCK',
+                LOCK_WAIT)
+        if timeout is None:
+            timeout = self.app.config.get('SQLALCHEMY_MIGRATE_LOCK_TIMEOUT')
+        if policy not in (LOCK_WAIT, LOCK_SKIP):
+            yield True
+            return
+        lock = _MigrationLock(self.engine)
+        if not lock.acquire(policy == LOCK_WAIT, timeout):
+            print('Migration is running on another node, skipped')
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            lock.release()
+
+    def migrate(self, upgrade, version, show=False, batch=False,
+            profile=None, top=PROFILE_TOP, lock=None, lock_timeout=None):
+        if show and version is None:
+            # listing is read-only and must not wait for a running migration
+            self._migrate(upgrade, version, show)
+            return
+        with self._migration_lock(lock, lock_timeout) as locked:
+            if locked:
+                if upgrade and not show:
+                    self._start_empty_database(version)
+                self._migrate(upgrade, version, show, batch, profile, top)
+
+    def _start_empty_database(self, version=None):
+        '''Put brand-new database under version control before upgrade:
+        create it from the models at the repository head, or start it from
+        the repository baseline'''
+        from migrate.exceptions import InvalidRepositoryError
+        from migrate.exceptions import DatabaseNotControlledError
+        try:
+            self._get_db_version()
+        except InvalidRepositoryError:
+            return
+        except DatabaseNotControlledError:
+            if not self._is_empty_database():
+                return
+            if version is None and self._create_fresh_database():
+                return
+            self._version_control(self._get_baseline_version() - 1)
 
     @with_version_control
-    def migrate(self, upgrade, version, show=False):
+    def _migrate(self, upgrade, version, show=False, batch=False,
+            profile=None, top=PROFILE_TOP):
+        if not show or version is not None:
+            self._check_baseline()
         if version is not None:
             db_version = self._get_db_version()
-            if db_version > version:
+            if batch and db_version != version:
+                self._migrate_batch(version)
+            elif profile and db_version != version:
+                self._migrate_profiled(version, profile, top)
+            elif db_version > version:
                 self._downgrade(version)
             elif db_version < version:
                 self._upgrade(version)
         elif show:
             self._show_migrations()
         elif upgrade:
-            self._upgrade(version)
+            if batch:
+                self._migrate_batch(version)
+            elif profile:
+                self._migrate_profiled(version, profile, top)
+            else:
+                self._upgrade(version)
+
+    def _check_baseline(self):
+        '''Raise MigrationError if the database is older than the baseline
+        of a squashed repository, replaying it would fail'''
+        baseline = self._get_baseline_version()
+        db_version = self._get_db_version()
+        if baseline == 1 or db_version >= baseline or \
+                db_version == baseline - 1 and self._is_empty_database():
+            return
+        raise MigrationError('Database is at version {0}, versions before '
+            '{1} are squashed into the baseline; migrate it with the '
+            'archived scripts first'.format(db_version, baseline))
+
+    @with_repository
+    def squash(self, upto):
+        '''Replace versions up to the given one with a baseline script'''
+        from migrate.exceptions import DatabaseNotControlledError
+        scripts = self._get_script_index()
+        baseline = self._get_baseline_version()
+        if not baseline < upto <= self._get_repo_version():
+            print('Can not squash: version must be greater than {0} and '
+                'not greater than {1}'.format(baseline,
+                    self._get_repo_version()))
+            return
+        try:
+            db_version = self._get_db_version()
+        except DatabaseNotControlledError:
+            db_version = None
+        if db_version is not None and db_version < upto:
+            print('Can not squash: database is at version {0}, migrate it '
+                'to version {1} first'.format(db_version, upto))
+            return
+        versions = self._get_versions_path()
+        script = [s['script'] for s in scripts if s['version'] == upto]
+        snapshot = script and self._get_snapshot_path(
+            os.path.join(versions, script[0]))
+        if not snapshot or not os.path.exists(snapshot):
+            print('Can not find schema snapshot for version {0}'.format(upto))
+            return
+        with open(snapshot, 'r') as f:
+            model = load_metadata(json.load(f))
+        archive = os.path.join(self.sqlalchemy_migration_path, 'archive')
+        if not os.path.exists(archive):
+            os.makedirs(archive)
+        for f in sorted(os.listdir(versions)):
+            m = re.match('^(?P<version>[0-9]+)_', f)
+            if m and int(m.group('version')) <= upto:
+                shutil.move(os.path.join(versions, f),
+                    os.path.join(archive, f))
+        self._invalidate('repository', 'controlled_schema')
+        self._create_migration_script('baseline', schema.MetaData(), model,
+            quiet=True, version=upto)
+        print('Versions {0}-{1} squashed into {2:03}_baseline.py, '
+            'originals archived in {3}'.format(baseline, upto, upto,
+                archive))
+
+    def _load_scripts(self):
+        '''Load modules of all migration scripts up front. Scripts of
+        different repositories share module names, so they are imported
+        one at a time and kept out of sys.modules'''
+        repository = self._get_repository()
+        with _SCRIPTS_LOCK:
+            for version in repository.versions.versions.values():
+                script = version.python
+                if script is None or '_module' in script.__dict__:
+                    continue
+                name = os.path.splitext(os.path.basename(script.path))[0]
+                previous = sys.modules.pop(name, None)
+                try:
+                    script.module
+                finally:
+                    sys.modules.pop(name, None)
+                    if previous is not None:
+                        sys.modules[name] = previous
+
+    @with_repository
+    def migrate_sql(self, output, version=None, start=None):
+        '''Save SQL of pending migrations into the output file. Return
+        False if it can not be rendered'''
+        sql = self._render_sql(version, start)
+        if sql is None:
+            return False
+        if output == '-':
+            print(sql)
+        else:
+            with open(output, 'wt') as f:
+                f.write(sql.encode('utf-8'))
+            print('Migration SQL saved as {0}'.format(output))
+        return True
+
+
+def get_binds(app):
+    '''Return names of the application databases, None is the default'''
+    return [None] + sorted(app.config.get('SQLALCHEMY_BINDS') or ())
+
+
+def migrate_binds(app, upgrade, version, show=False, batch=False,
+                    profile=None, top=PROFILE_TOP, workers=None, lock=None,
+                    lock_timeout=None):
+    '''Migrate databases of all binds concurrently and report each of
+    them. Return list of (bind, error, elapsed) tuples'''
+    from multiprocessing.pool import ThreadPool
+    binds = get_binds(app)
+
+    def run(bind):
+        start = time.time()
+        report = profile
+        if profile and bind is not None:
+            root, ext = os.path.splitext(profile)
+            report = '{0}_{1}{2}'.format(root, bind, ext)
+        try:
+            with app.app_context():
+                dbmigrate = DBMigrate(app, bind)
+                if show:
+                    print('{0}:'.format(bind or 'default'))
+                else:
+                    dbmigrate._load_scripts()
+                dbmigrate.migrate(upgrade, version, show, batch, report, top,
+                    lock, lock_timeout)
+        except Exception, e:
+            return bind, e, time.time() - start
+        return bind, None, time.time() - start
+
+    # listing is printed bind after bind
+    workers = 1 if show else min(workers or app.config.get(
+        'SQLALCHEMY_MIGRATE_BIND_WORKERS', BIND_WORKERS), len(binds))
+    pool = ThreadPool(workers)
+    try:
+        results = pool.map(run, binds)
+    finally:
+        pool.close()
+        pool.join()
+    if not show:
+        for bind, error, elapsed in results:
+            if error is None:
+                print('{0}: migrated in {1:.3f}s'.format(bind or 'default',
+                    elapsed))
+            else:
+                print('{0}: failed in {1:.3f}s: {2!r}'.format(
+                    bind or 'default', elapsed, error))
+    return results
+
+
+def _read_targets(path):
+    '''Return targets listed in the file, one per line'''
+    targets = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line and line not in targets:
+                targets.append(line)
+    return targets
+
+
+def _get_target_engine(uri, target):
+    '''Return engine of the target database URI, or of the schema of the
+    application database'''
+    from sqlalchemy.pool import NullPool
+    if '://' in target:
+        return create_engine(target, poolclass=NullPool)
+    url = make_url(uri)
+    if url.drivername.startswith('mysql'):
+        url.database = target
+        return create_engine(url, poolclass=NullPool)
+    if not url.drivername.startswith('postgresql'):
+        raise ImproperlyConfigured('Schema targets are supported only for '
+            'PostgreSQL and MySQL')
+    engine = create_engine(url, poolclass=NullPool)
+    search_path = 'SET search_path TO {0}'.format(
+        engine.dialect.identifier_preparer.quote_identifier(target))
+
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(search_path)
+        cursor.close()
+        # otherwise the first rollback resets search_path
+        dbapi_connection.commit()
+
+    event.listen(engine, 'connect', connect)
+    return engine
+
+
+# state shared with forked fleet workers
+_fleet = {}
+
+
+def _migrate_target(target):
+    start = time.time()
+    try:
+        engine = _get_target_engine(_fleet['uri'], target)
+        try:
+            dbmigrate = DBMigrate(_fleet['app'], engine=engine)
+            dbmigrate.db = _fleet['db']
+            dbmigrate._cache = {'repository': _fleet['repository']}
+            dbmigrate.migrate(_fleet['upgrade'], _fleet['version'],
+                lock=_fleet['lock'], lock_timeout=_fleet['lock_timeout'])
+            version = int(dbmigrate._get_db_version())
+        finally:
+            engine.dispose()
+    except Exception, e:
+        return target, None, repr(e), time.time() - start
+    if version != _fleet['head']:
+        return target, version, 'stopped at version {0}'.format(version), \
+            time.time() - start
+    return target, version, None, time.time() - start
+
+
+def migrate_targets(app, path, upgrade, version, workers=None, lock=None,
+                    lock_timeout=None):
+    '''Migrate every database listed in the targets file (URIs or schema
+    names of the application database) on a pool of worker processes.
+    Migrated targets are recorded in a journal next to the file, so an
+    interrupted run resumes where it stopped. Return number of failed
+    targets'''
+    import multiprocessing
+    dbmigrate = DBMigrate(app)
+    repository = dbmigrate._get_repository()
+    head = version if version is not None else int(repository.latest)
+    journal = path + JOURNAL_EXTENSION
+    done = set()
+    if os.path.exists(journal):
+        with open(journal, 'r') as f:
+            for line in f:
+                target, _, target_version = line.rstrip('\n').rpartition(' ')
+                if target_version == str(head):
+                    done.add(target)
+    targets = _read_targets(path)
+    pending = [t for t in targets if t not in done]
+
+    # workers are forked with the parsed repository and loaded scripts
+    dbmigrate._cache = {'repository': repository}
+    dbmigrate._load_scripts()
+    _fleet.update(app=app, db=dbmigrate.db, repository=repository,
+        uri=dbmigrate.sqlalchemy_database_uri, upgrade=upgrade,
+        version=version, head=head, lock=lock, lock_timeout=lock_timeout)
+    workers = min(workers or app.config.get('SQLALCHEMY_MIGRATE_FLEET_WORKERS',
+        FLEET_WORKERS), len(pending)) or 1
+    start = time.time()
+    failed = 0
+    pool = multiprocessing.Pool(workers)
+    try:
+        with open(journal, 'a') as f:
+            for target, target_version, error, elapsed in \
+                pool.imap_unordered(_migrate_target, pending):
+                if error is None:
+                    f.write('{0} {1}\n'.format(target, target_version))
+                    f.flush()
+                else:
+                    failed += 1
+                    print('{0}: failed in {1:.3f}s: {2}'.format(target,
+                        elapsed, error))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        _fleet.clear()
+    elapsed = time.time() - start
+    print('Migrated {0} of {1} targets in {2:.3f}s ({3:.1f} targets/s), '
+        '{4} skipped, {5} failed'.format(len(pending) - failed, len(targets),
+            elapsed, (len(pending) - failed) / elapsed if elapsed else 0.0,
+            len(targets) - len(pending), failed))
+    if not failed:
+        os.remove(journal)
+    return failed
+
 
 manager = Manager(usage='Perform database schema change management')
 
@@ -232,17 +3015,49 @@ def test():
 
 
 @manager.command
-def init():
+def init(reflect=False, bind=None):
     'Initialize migration repository and create database'
-    dbmigrate = DBMigrate(current_app)
-    dbmigrate.init()
+    dbmigrate = DBMigrate(current_app, bind)
+    dbmigrate.init(reflect)
 
 
-@manager.command
-def schemamigration(name='auto_generated', stdout=False):
-    'Create migration'
-    dbmigrate = DBMigrate(current_app)
-    dbmigrate.schemamigrate(name, stdout)
+class SchemaMigration(Command):
+
+    option_list = (
+        Option('--name', '-n', dest='name', default='auto_generated'),
+        Option('--stdout', '-s', default=False, action='store_true'),
+        Option('--reflect', '-r', default=False, action='store_true'),
+        Option('--scoped', default=False, action='store_true'),
+        Option('--workers', '-w', dest='workers', type=int, required=False),
+        Option('--bind', dest='bind', required=False),
+        Option('--advise', '-a', default=False, action='store_true'),
+        Option('--add-indexes', dest='add_indexes', default=False,
+            action='store_true'),
+        Option('--online', default=False, action='store_true'),
+    )
+
+    def run(self, name, stdout, reflect, scoped, workers, bind, advise,
+            add_indexes, online):
+        '''Create migration'''
+        dbmigrate = DBMigrate(current_app, bind)
+        dbmigrate.schemamigrate(name, stdout, reflect, scoped, workers,
+            advise, add_indexes, online)
+
+manager.add_command('schemamigration', SchemaMigration())
+
+
+class Squash(Command):
+
+    option_list = (
+        Option('--upto', '-u', dest='upto', type=int, required=True),
+    )
+
+    def run(self, upto):
+        '''Squash migrations into a baseline script'''
+        dbmigrate = DBMigrate(current_app)
+        dbmigrate.squash(upto)
+
+manager.add_command('squash', Squash())
 
 
 class Migrate(Command):
@@ -250,12 +3065,56 @@ class Migrate(Command):
     option_list = (
         Option('--upgrade', '-u', default=True, action='store_true'),
         Option('--show', '-s', default=False, action='store_true'),
+        Option('--batch', '-b', default=False, action='store_true'),
+        Option('--sql', dest='sql', required=False, metavar='FILE'),
+        Option('--from', dest='start', type=int, required=False),
+        Option('--profile', '-p', dest='profile', required=False,
+            metavar='FILE'),
+        Option('--top', dest='top', type=int, default=PROFILE_TOP),
+        Option('--bind', dest='bind', required=False),
+        Option('--workers', '-w', dest='workers', type=int, required=False),
+        Option('--targets', '-t', dest='targets', required=False,
+            metavar='FILE'),
+        Option('--lock', dest='lock', required=False,
+            choices=(LOCK_WAIT, LOCK_SKIP, 'off')),
+        Option('--lock-timeout', dest='lock_timeout', type=int,
+            required=False),
+        Option('--plan', default=False, action='store_true'),
+        Option('--budget', dest='budget', type=float, required=False),
         Option('-v', dest='version', type=int, required=False),
     )
 
-    def run(self, upgrade, version, show):
+    def run(self, upgrade, version, show, batch, sql, start, profile, top,
+            bind, workers, targets, lock, lock_timeout, plan, budget):
         '''Migrate database'''
-        dbmigrate = DBMigrate(current_app)
-        dbmigrate.migrate(upgrade, version, show)
+        if plan:
+            if DBMigrate(current_app, bind).migrate_plan(version,
+                budget) is None:
+                return 1
+            return
+        if targets:
+            if migrate_targets(current_app._get_current_object(), targets,
+                upgrade, version, workers, lock, lock_timeout):
+                return 1
+            return
+        if bind is None and not sql and current_app.config.get(
+            'SQLALCHEMY_BINDS'):
+            results = migrate_binds(current_app._get_current_object(),
+                upgrade, version, show, batch, profile, top, workers, lock,
+                lock_timeout)
+            if any(error is not None for bind, error, elapsed in results):
+                return 1
+            return
+        dbmigrate = DBMigrate(current_app, bind)
+        if sql:
+            if not dbmigrate.migrate_sql(sql, version, start):
+                return 1
+            return
+        try:
+            dbmigrate.migrate(upgrade, version, show, batch, profile, top,
+                lock, lock_timeout)
+        except MigrationError, e:
+            print(e)
+            return 1
 
 manager.add_command('migrate', Migrate())
@@ -1,8 +1,13 @@
 import os
 import re
 import sys
+import json
+import time
+import sqlite3
 import unittest
 import logging
+import threading
+import subprocess
 from shutil import rmtree
 from StringIO import StringIO
 
@@ -10,9 +15,21 @@ from flask import Flask
 from flask.ext.script import Command, Manager
 from flask.ext.sqlalchemy import SQLAlchemy
 
+from sqlalchemy import create_engine, MetaData, Table, Column, Integer
+from sqlalchemy import Enum, ForeignKey, Index, String, event
 from sqlalchemy.engine.reflection import Inspector
-
-from flask_dbmigrate import DBMigrate, ImproperlyConfigured
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.dialects import mysql, postgresql
+
+from migrate.versioning import util as migrate_util
+
+from flask_dbmigrate import DBMigrate, ImproperlyConfigured, load_metadata
+from flask_dbmigrate import dump_metadata
+from flask_dbmigrate import backfill, with_template_database
+from flask_dbmigrate import alter_table_online, _get_expand_model
+from flask_dbmigrate import _coalesced, _execute_autocommit, _get_coalescer
+from flask_dbmigrate import LockTimeout, MigrationError, _get_lock_table
+from flask_dbmigrate import _MigrationLock
 from flask_dbmigrate import manager as dbmanager
 
 
@@ -89,6 +106,18 @@ class DBMigrateInitTestCase(unittest.TestCase):
         app.config.from_object(TestConfig)
         DBMigrate(app)
 
+    def test_dbmigrate_lazy_import(self):
+        # sqlalchemy-migrate and Flask-SQLAlchemy are imported only when a
+        # command needs them, so the module itself must be cheap to import
+        code = ('import sys\n'
+            'import flask_dbmigrate\n'
+            'print(any(m.split(".")[0] == "migrate" for m in sys.modules))\n')
+        process = subprocess.Popen([sys.executable, '-c', code],
+            stdout=subprocess.PIPE, cwd=rel(''))
+        output = process.communicate()[0]
+        self.assertEquals(process.returncode, 0)
+        self.assertEquals(output.strip(), 'False')
+
 
 class DBMigrateSubManagerTestCase(unittest.TestCase):
 
@@ -144,6 +173,24 @@ class DBMigrateCommandsTestCase(unittest.TestCase):
         if os.path.exists(rel('test.sqlite3')):
             os.remove(rel('test.sqlite3'))
 
+    def test_init_existing_database(self):
+
+        # tables of the models already exist and have rows
+        self.app.db.create_all()
+        self.app.db.session.add(self.Test('value'))
+        self.app.db.session.commit()
+
+        self.dbmigrate.init()
+
+        script = os.path.join(self.dbmigrate._get_versions_path(),
+            '001_initial.py')
+        assert '.create()' not in open(script).read()
+
+        self.dbmigrate.migrate(upgrade=True, version=None)
+        assert self.dbmigrate._get_db_version() == 1
+        self.assertEquals(self.dbmigrate.engine.execute(
+            'SELECT column1 FROM test').fetchall(), [('value',)])
+
     def test_init(self):
 
         manager = Manager(self.app)
@@ -167,6 +214,60 @@ class DBMigrateCommandsTestCase(unittest.TestCase):
         # drop
         self.dbmigrate._drop()
 
+    def test_init_fresh_database(self):
+
+        self.dbmigrate.init()
+
+        # empty database is created from the models and stamped at head
+        assert self.dbmigrate._get_db_version() == 1
+        assert 'test' in Inspector(self.dbmigrate.db.engine
+            ).get_table_names()
+
+        self.dbmigrate._drop()
+
+    @with_database_changes
+    def test_migrate_fresh_database(self):
+
+        self.dbmigrate.db = self.app.db
+        self.dbmigrate.schemamigrate(migration_name='added_column2')
+
+        # brand-new database
+        os.remove(rel('test.sqlite3'))
+
+        manager = Manager(self.app)
+        manager.add_command('dbmigrate', dbmanager)
+
+        sys.argv = ['manage.py', 'dbmigrate', 'migrate']
+
+        try:
+            manager.run()
+        except SystemExit, e:
+            self.assertEquals(e.code, 0)
+
+        assert self.dbmigrate._get_db_version() == 2
+
+        i = Inspector(self.dbmigrate.db.engine)
+        assert 'column2' in [c['name'] for c in i.get_columns('test')]
+
+    @with_database_changes
+    def test_migrate_show_empty_database(self):
+
+        self.dbmigrate.db = self.app.db
+        self.dbmigrate.schemamigrate(migration_name='added_column2')
+
+        # brand-new database
+        os.remove(rel('test.sqlite3'))
+
+        # listing does not create the database
+        self.dbmigrate.migrate(upgrade=True, version=None, show=True)
+        assert 'Try to "init" it first' in self.output.getvalue()
+        self.assertEquals(Inspector(self.dbmigrate.engine).get_table_names(),
+            [])
+
+        # upgrade to the given version replays the scripts
+        self.dbmigrate.migrate(upgrade=True, version=1)
+        assert self.dbmigrate._get_db_version() == 1
+
     def test_schemamigrate_no_repository(self):
 
         manager = Manager(self.app)
@@ -254,6 +355,183 @@ class DBMigrateCommandsTestCase(unittest.TestCase):
         pattern = re.compile('^# __VERSION__: (?P<version>\d+)\n')
         self.assertTrue(re.search(pattern, output))
 
+    def test_init_schema_snapshot(self):
+
+        self.dbmigrate.init()
+
+        snapshot = os.path.join(self.app.config['SQLALCHEMY_MIGRATE_REPO'],
+            'versions/001_initial.json')
+
+        self.assertTrue(os.path.exists(snapshot))
+
+        with open(snapshot) as f:
+            model = load_metadata(json.load(f))
+
+        assert 'test' in model.tables
+        assert 'column1' in model.tables['test'].columns
+
+        self.dbmigrate._drop()
+
+    @with_database_changes
+    def test_schemamigrate_with_changes_offline(self):
+
+        # snapshot based autogenerate must not touch the database
+        os.remove(rel('test.sqlite3'))
+
+        manager = Manager(self.app)
+        manager.add_command('dbmigrate', dbmanager)
+
+        sys.argv = ['manage.py', 'dbmigrate', 'schemamigration']
+
+        try:
+            manager.run()
+        except SystemExit, e:
+            self.assertEquals(e.code, 0)
+
+        migration = os.path.join(self.app.config['SQLALCHEMY_MIGRATE_REPO'],
+            'versions/002_auto_generated.py')
+
+        self.assertTrue(os.path.exists(migration))
+        self.assertFalse(os.path.exists(rel('test.sqlite3')))
+
+    @with_database_changes
+    def test_schemamigrate_with_changes_reflect(self):
+
+        manager = Manager(self.app)
+        manager.add_command('dbmigrate', dbmanager)
+
+        sys.argv = ['manage.py', 'dbmigrate', 'schemamigration', '--reflect']
+
+        try:
+            manager.run()
+        except SystemExit, e:
+            self.assertEquals(e.code, 0)
+
+        migration = os.path.join(self.app.config['SQLALCHEMY_MIGRATE_REPO'],
+            'versions/002_auto_generated.py')
+
+        self.assertTrue(os.path.exists(migration))
+
+    @with_database_changes
+    def test_schemamigrate_with_changes_scoped(self):
+
+        # table managed by another service must not be reflected
+        self.app.db.engine.execute('CREATE TABLE unmanaged (id INTEGER)')
+
+        manager = Manager(self.app)
+        manager.add_command('dbmigrate', dbmanager)
+
+        sys.argv = ['manage.py', 'dbmigrate', 'schemamigration', '--scoped',
+            '-w', '2']
+
+        try:
+            manager.run()
+        except SystemExit, e:
+            self.assertEquals(e.code, 0)
+
+        migration = os.path.join(self.app.config['SQLALCHEMY_MIGRATE_REPO'],
+            'versions/002_auto_generated.py')
+
+        self.assertTrue(os.path.exists(migration))
+
+        with open(migration) as f:
+            assert 'unmanaged' not in f.read()
+
+        assert 'Reflected test in' in sys.stdout.getvalue()
+
+    def test_fingerprint(self):
+
+        self.dbmigrate.init()
+
+        snapshot = os.path.join(self.app.config['SQLALCHEMY_MIGRATE_REPO'],
+            'versions/001_initial.json')
+
+        with open(snapshot) as f:
+            model = load_metadata(json.load(f))
+
+        self.assertEquals(self.dbmigrate.fingerprint(),
+            self.dbmigrate.fingerprint(model))
+
+        # add column2 to the model
+        self.app.db.metadata.tables['test'].append_column(
+            self.app.db.Column('column2', self.app.db.String(60)))
+
+        self.assertNotEquals(self.dbmigrate.fingerprint(),
+            self.dbmigrate.fingerprint(model))
+
+        # removed and added tables are both changes
+        assert self.dbmigrate._is_changed(model, MetaData())
+        assert self.dbmigrate._is_changed(MetaData(), model)
+
+        self.dbmigrate._drop()
+
+    def test_fingerprint_dialect_types(self):
+
+        def make_model(type_):
+            model = MetaData()
+            Table('test', model, Column('id', Integer, primary_key=True),
+                Column('value', type_))
+            return model
+
+        models = [make_model(type_) for type_ in (postgresql.UUID(),
+            postgresql.INET(), postgresql.ARRAY(Integer),
+            postgresql.ARRAY(String), mysql.INTEGER(unsigned=True),
+            mysql.INTEGER())]
+
+        # dialect types and their arguments are not reduced to the
+        # generic type
+        fingerprints = [self.dbmigrate.fingerprint(m) for m in models]
+        self.assertEquals(len(set(fingerprints)), len(models))
+
+        # snapshot keeps the dialect type
+        for model in models:
+            loaded = load_metadata(json.loads(json.dumps(
+                dump_metadata(model))))
+            self.assertEquals(
+                repr(loaded.tables['test'].columns['value'].type),
+                repr(model.tables['test'].columns['value'].type))
+            self.assertEquals(self.dbmigrate.fingerprint(loaded),
+                self.dbmigrate.fingerprint(model))
+        self.assertEquals(load_metadata(dump_metadata(models[4])).tables[
+            'test'].columns['value'].type.unsigned, True)
+
+        # keyword only arguments, PostgreSQL requires name of ENUM
+        kinds = [make_model(Enum('a', 'b', name=name, native_enum=native))
+            for name, native in (('kind', True), ('sort', True),
+                ('kind', False))]
+        self.assertEquals(len(set(self.dbmigrate.fingerprint(m)
+            for m in kinds)), 3)
+        loaded = load_metadata(dump_metadata(kinds[2])).tables[
+            'test'].columns['value'].type
+        self.assertEquals((loaded.name, loaded.native_enum), ('kind', False))
+
+    def test_script_index(self):
+
+        self.dbmigrate.init()
+
+        versions = os.path.join(self.app.config['SQLALCHEMY_MIGRATE_REPO'],
+            'versions')
+
+        for version in (999, 1000):
+            with open(os.path.join(versions,
+                '{0}_script.py'.format(version)), 'wt') as f:
+                f.write('# __VERSION__: {0}\n'.format(version))
+
+        # scripts are ordered numerically
+        self.assertEquals(self.dbmigrate._get_migration_scripts(),
+            ['001_initial.py', '999_script.py', '1000_script.py'])
+
+        self.assertTrue(os.path.exists(os.path.join(versions, 'index.json')))
+
+        # changed script is indexed again
+        with open(os.path.join(versions, '1000_script.py'), 'wt') as f:
+            f.write('# __VERSION__: 1001\n\n')
+
+        self.assertEquals(self.dbmigrate._get_script_index()[-1]['version'],
+            1001)
+
+        self.dbmigrate._drop()
+
     def test_migrate_show_no_migrations(self):
 
         self.dbmigrate.init()
@@ -322,6 +600,552 @@ class DBMigrateCommandsTestCase(unittest.TestCase):
         # check if column "column2" exists in table "test"
         assert 'column2' in [c['name'] for c in i.get_columns('test')]
 
+    @with_database_changes
+    def test_migrate_shared_engine(self):
+
+        self.dbmigrate.db = self.app.db
+        self.dbmigrate.schemamigrate(migration_name='added_column2')
+
+        def construct_engine(*args, **kwargs):
+            raise AssertionError('DBMigrate must use application engine')
+
+        manager = Manager(self.app)
+        manager.add_command('dbmigrate', dbmanager)
+
+        sys.argv = ['manage.py', 'dbmigrate', 'migrate']
+
+        original = migrate_util.construct_engine
+        migrate_util.construct_engine = construct_engine
+        try:
+            manager.run()
+        except SystemExit, e:
+            self.assertEquals(e.code, 0)
+        finally:
+            migrate_util.construct_engine = original
+
+        assert self.dbmigrate._get_db_version() == 2
+
+    @with_database_changes
+    def test_migrate_upgrade_batch(self):
+
+        self.dbmigrate.db = self.app.db
+        self.dbmigrate.schemamigrate(migration_name='added_column2')
+
+        manager = Manager(self.app)
+        manager.add_command('dbmigrate', dbmanager)
+
+        sys.argv = ['manage.py', 'dbmigrate', 'migrate', '--batch']
+
+        try:
+            manager.run()
+        except SystemExit, e:
+            self.assertEquals(e.code, 0)
+
+        assert self.dbmigrate._get_db_version() == 2
+
+        i = Inspector(self.dbmigrate.db.engine)
+
+        # check if column "column2" exists in table "test"
+        assert 'column2' in [c['name'] for c in i.get_columns('test')]
+
+    @with_database_changes
+    def test_migrate_upgrade_coalesced(self):
+
+        self.dbmigrate.db = self.app.db
+        self.dbmigrate.schemamigrate(migration_name='added_column2')
+        self.dbmigrate.migrate(upgrade=True, version=None)
+
+        engine = self.dbmigrate.engine
+        engine.execute('CREATE INDEX ix_test_column1 ON test (column1)')
+        engine.execute('INSERT INTO test (column1, column2) '
+            'VALUES (\'value1\', \'value2\')')
+
+        migration = os.path.join(self.app.config['SQLALCHEMY_MIGRATE_REPO'],
+            'versions/003_changes.py')
+        with open(migration, 'wt') as f:
+            f.write('# __VERSION__: 3\n'
+                'from sqlalchemy import *\n'
+                'from migrate import *\n'
+                'meta = MetaData()\n'
+                'test = Table("test", meta,\n'
+                '    Column("test_id", Integer, primary_key=True),\n'
+                '    Column("column1", String(60)),\n'
+                '    Column("column2", String(60)))\n'
+                'def upgrade(migrate_engine):\n'
+                '    meta.bind = migrate_engine\n'
+                '    test.c.column1.alter(type=Text)\n'
+                '    test.c.column2.alter(name="column3")\n'
+                '    Column("column4", String(60)).create(test)\n')
+
+        statements = []
+
+        def record(conn, cursor, statement, parameters, *args):
+            statements.append(statement)
+            return statement, parameters
+        event.listen(engine, 'before_cursor_execute', record, retval=True)
+        try:
+            self.dbmigrate.migrate(upgrade=True, version=None)
+        finally:
+            engine.dispatch.before_cursor_execute.remove(record, engine)
+
+        # SQLite table is rebuilt once for both changes
+        self.assertEquals(len([s for s in statements
+            if 'RENAME TO migration_tmp' in s]), 1)
+
+        i = Inspector(engine)
+        columns = dict((c['name'], c) for c in i.get_columns('test'))
+        self.assertEquals(sorted(columns), ['column1', 'column3', 'column4',
+            'test_id'])
+        self.assertEquals(str(columns['column1']['type']), 'TEXT')
+        self.assertEquals([index['name'] for index in i.get_indexes('test')],
+            ['ix_test_column1'])
+        self.assertEquals(engine.execute('SELECT column1, column3 FROM test'
+            ).fetchall(), [('value1', 'value2')])
+
+    @with_database_changes
+    def test_migrate_lock_timeout_retry(self):
+
+        self.app.config['SQLALCHEMY_MIGRATE_DDL_LOCK_TIMEOUT'] = 0.05
+        self.app.config['SQLALCHEMY_MIGRATE_RETRIES'] = 10
+        self.app.config['SQLALCHEMY_MIGRATE_RETRY_DELAY'] = 0.05
+        self.dbmigrate.db = self.app.db
+        self.dbmigrate.schemamigrate(migration_name='added_column2')
+
+        # pool which reuses connections, SQLite files use NullPool
+        engine = self.dbmigrate.engine
+        null_pool = engine.pool
+        engine.pool = QueuePool(null_pool._creator, pool_size=1)
+        used = set()
+
+        def checkout(dbapi_connection, record, proxy):
+            used.add(dbapi_connection)
+
+        event.listen(engine.pool, 'checkout', checkout)
+
+        # another connection holds the write lock for a while
+        holder = sqlite3.connect(rel('test.sqlite3'), check_same_thread=False)
+        holder.isolation_level = None
+        holder.execute('BEGIN IMMEDIATE')
+        release = threading.Timer(0.3, holder.rollback)
+        release.start()
+        try:
+            self.dbmigrate.migrate(upgrade=True, version=None, lock='off')
+        finally:
+            release.join()
+            holder.close()
+            engine.pool.dispatch.checkout.remove(checkout, engine.pool)
+
+        assert self.dbmigrate._get_db_version() == 2
+        assert 'Version 2 timed out waiting for a lock, retrying in 0.05s ' \
+            '(attempt 2 of 11)' in self.output.getvalue()
+
+        # timeouts are restored on connections returned to the pool
+        try:
+            connection = engine.connect()
+            assert connection.connection.connection in used
+            self.assertEquals(connection.execute(
+                'PRAGMA busy_timeout').scalar(), 5000)
+            connection.close()
+        finally:
+            engine.pool.dispose()
+            engine.pool = null_pool
+
+    @with_database_changes
+    def test_migrate_upgrade_batch_failure(self):
+
+        self.dbmigrate.db = self.app.db
+        self.dbmigrate.schemamigrate(migration_name='added_column2')
+
+        migration = os.path.join(self.app.config['SQLALCHEMY_MIGRATE_REPO'],
+            'versions/003_broken.py')
+        with open(migration, 'wt') as f:
+            f.write('# __VERSION__: 3\n'
+                'def upgrade(migrate_engine):\n'
+                '    migrate_engine.execute("CREATE TABLE t3 (id INTEGER)")\n'
+                '    raise RuntimeError("broken")\n')
+
+        self.assertRaises(RuntimeError, self.dbmigrate.migrate, upgrade=True,
+            version=None, batch=True)
+
+        # nothing from the failed chain is left in the database
+        assert self.dbmigrate._get_db_version() == 1
+
+        i = Inspector(self.dbmigrate.db.engine)
+
+        assert 't3' not in i.get_table_names()
+        assert 'column2' not in [c['name'] for c in i.get_columns('test')]
+
+    @with_database_changes
+    def test_migrate_upgrade_profile(self):
+
+        self.dbmigrate.db = self.app.db
+        self.dbmigrate.schemamigrate(migration_name='added_column2')
+
+        report = os.path.join(self.app.config['SQLALCHEMY_MIGRATE_REPO'],
+            'profile.json')
+
+        manager = Manager(self.app)
+        manager.add_command('dbmigrate', dbmanager)
+
+        sys.argv = ['manage.py', 'dbmigrate', 'migrate', '--upgrade',
+            '--profile', report]
+
+        try:
+            manager.run()
+        except SystemExit, e:
+            self.assertEquals(e.code, 0)
+
+        assert self.dbmigrate._get_db_version() == 2
+
+        with open(report) as f:
+            profile = json.load(f)
+
+        self.assertEquals([v['version'] for v in profile['versions']], [2])
+        statements = profile['versions'][0]['statements']
+        assert any('ALTER TABLE test ADD column2' in s['statement']
+            for s in statements)
+        assert all(s['elapsed'] >= 0 for s in statements)
+        assert 'Top' in self.output.getvalue()
+
+    @with_database_changes
+    def test_migrate_lock(self):
+
+        self.dbmigrate.db = self.app.db
+        self.dbmigrate.schemamigrate(migration_name='added_column2')
+
+        engine = self.dbmigrate.engine
+        _get_lock_table(engine)
+        engine.execute("INSERT INTO migrate_lock (name, holder, acquired) "
+            "VALUES ('flask_dbmigrate', 'node', {0})".format(int(time.time())))
+
+        # another node holds the lock
+        self.dbmigrate.migrate(upgrade=True, version=None, lock='skip')
+        assert 'skipped' in self.output.getvalue()
+        assert self.dbmigrate._get_db_version() == 1
+
+        self.assertRaises(LockTimeout, self.dbmigrate.migrate, upgrade=True,
+            version=None, lock='wait', lock_timeout=0)
+
+        engine.execute('DELETE FROM migrate_lock')
+
+        self.dbmigrate.migrate(upgrade=True, version=None, lock='skip')
+        assert self.dbmigrate._get_db_version() == 2
+
+        # lock is released after migration
+        self.assertEquals(engine.execute(
+            'SELECT COUNT(*) FROM migrate_lock').scalar(), 0)
+
+    def test_migrate_lock_refresh(self):
+
+        engine = self.dbmigrate.engine
+        lock = _MigrationLock(engine, refresh_interval=0.05)
+        assert lock.acquire(wait=False)
+        try:
+            # migration is running longer than the lock expiry
+            engine.execute('UPDATE migrate_lock SET acquired = 0')
+            time.sleep(0.5)
+
+            other = _MigrationLock(engine)
+            assert not other.acquire(wait=False)
+            assert engine.execute(
+                'SELECT acquired FROM migrate_lock').scalar() > 0
+        finally:
+            lock.release()
+        self.assertEquals(engine.execute(
+            'SELECT COUNT(*) FROM migrate_lock').scalar(), 0)
+
+    def test_lock_table_concurrent_create(self):
+
+        engine = self.dbmigrate.engine
+
+        def create(conn, cursor, statement, parameters, *args):
+            # another node creates the table after the check
+            if statement.strip().startswith('CREATE TABLE migrate_lock'):
+                other = sqlite3.connect(rel('test.sqlite3'))
+                other.execute('CREATE TABLE migrate_lock (name TEXT)')
+                other.close()
+            return statement, parameters
+
+        event.listen(engine, 'before_cursor_execute', create, retval=True)
+        try:
+            _get_lock_table(engine)
+        finally:
+            engine.dispatch.before_cursor_execute.remove(create, engine)
+
+        assert 'migrate_lock' in Inspector(engine).get_table_names()
+        engine.execute('DROP TABLE migrate_lock')
+
+    @with_database_changes
+    def test_is_current(self):
+
+        assert self.dbmigrate.is_current()
+        self.assertEquals(self.dbmigrate.pending_versions(), [])
+
+        self.dbmigrate.db = self.app.db
+        self.dbmigrate.schemamigrate(migration_name='added_column2')
+
+        assert not self.dbmigrate.is_current()
+        self.assertEquals(self.dbmigrate.pending_versions(), [2])
+
+        self.dbmigrate.migrate(upgrade=True, version=None)
+
+        assert self.dbmigrate.is_current()
+        self.assertEquals(self.dbmigrate.pending_versions(), [])
+
+    @with_database_changes
+    def test_schemamigrate_indexes(self):
+
+        self.dbmigrate.db = self.app.db
+        self.dbmigrate.schemamigrate(migration_name='added_column2')
+        self.dbmigrate.migrate(upgrade=True, version=None)
+
+        # indexes alone are a change of the model
+        test = self.app.db.metadata.tables['test']
+        self.app.db.Index('ix_test_column2', test.c.column2)
+        self.app.db.Index('ix_test_columns', test.c.column1, test.c.column2,
+            unique=True)
+
+        self.dbmigrate.schemamigrate(migration_name='added_indexes')
+        self.dbmigrate.migrate(upgrade=True, version=None)
+        assert self.dbmigrate._get_db_version() == 3
+
+        i = Inspector(self.dbmigrate.engine)
+        indexes = dict((index['name'], index)
+            for index in i.get_indexes('test'))
+
+        self.assertEquals(sorted(indexes), ['ix_test_column2',
+            'ix_test_columns'])
+        self.assertEquals(indexes['ix_test_columns']['column_names'],
+            ['column1', 'column2'])
+        assert indexes['ix_test_columns']['unique']
+
+        self.dbmigrate.schemamigrate(migration_name='no_changes')
+        assert self.output.getvalue().endswith('No Changes!\n')
+
+        self.dbmigrate.migrate(upgrade=True, version=2)
+
+        i = Inspector(self.dbmigrate.engine)
+        self.assertEquals(i.get_indexes('test'), [])
+
+    @with_database_changes
+    def test_schemamigrate_online(self):
+
+        self.dbmigrate.db = self.app.db
+        self.dbmigrate.schemamigrate(migration_name='added_column2')
+        self.dbmigrate.migrate(upgrade=True, version=None)
+        self.dbmigrate.engine.execute(
+            'INSERT INTO test (column1) VALUES (\'value\')')
+
+        # NOT NULL column is added nullable, filled and constrained later
+        test = self.app.db.metadata.tables['test']
+        test.append_column(self.app.db.Column('column3',
+            self.app.db.String(60), nullable=False, default='empty'))
+        self.app.db.Index('ix_test_column3', test.c.column3)
+
+        self.dbmigrate.schemamigrate(migration_name='column3', online=True)
+        scripts = self.dbmigrate._get_migration_scripts()
+        self.assertEquals(scripts[-2:], ['003_column3_expand.py',
+            '004_column3_contract.py'])
+        expand = open(os.path.join(self.dbmigrate._get_versions_path(),
+            scripts[-2])).read()
+        assert 'create_index_online(migrate_engine, index)' in expand
+        assert 'backfill(migrate_engine' in expand
+
+        # online helpers commit on their own connections
+        self.assertRaises(MigrationError, self.dbmigrate.migrate,
+            upgrade=True, version=None, batch=True)
+        assert self.dbmigrate._get_db_version() == 2
+
+        # backfill renders offline, NOT NULL on SQLite needs reflection
+        output = os.path.join(self.app.config['SQLALCHEMY_MIGRATE_REPO'],
+            'online.sql')
+        assert self.dbmigrate.migrate_sql(output, version=3)
+        assert 'UPDATE test SET column3' in open(output).read()
+        assert not self.dbmigrate.migrate_sql(output)
+        assert 'Version 3 (004_column3_contract.py) can not be rendered ' \
+            'without database connection' in self.output.getvalue()
+
+        self.dbmigrate.migrate(upgrade=True, version=3)
+        i = Inspector(self.dbmigrate.engine)
+        column3 = [c for c in i.get_columns('test')
+            if c['name'] == 'column3'][0]
+        assert column3['nullable']
+        self.assertEquals(self.dbmigrate.engine.execute(
+            'SELECT column3 FROM test').fetchall(), [('empty',)])
+        self.assertEquals([index['name'] for index in i.get_indexes('test')],
+            ['ix_test_column3'])
+
+        self.dbmigrate.migrate(upgrade=True, version=None)
+        i = Inspector(self.dbmigrate.engine)
+        column3 = [c for c in i.get_columns('test')
+            if c['name'] == 'column3'][0]
+        assert not column3['nullable']
+        self.assertEquals([index['name'] for index in i.get_indexes('test')],
+            ['ix_test_column3'])
+
+        self.dbmigrate.migrate(upgrade=False, version=2)
+        i = Inspector(self.dbmigrate.engine)
+        assert 'column3' not in [c['name'] for c in i.get_columns('test')]
+
+    def test_expand_model_type_change(self):
+
+        old, new = MetaData(), MetaData()
+        Table('test', old, Column('id', Integer, primary_key=True),
+            Column('value', String(20)))
+        Table('test', new, Column('id', Integer, primary_key=True),
+            Column('value', String(100)), Column('note', String(20)))
+
+        # changed column keeps its type until the contract step
+        expand, constrain, changed = _get_expand_model(old, new)
+        self.assertEquals(expand.tables['test'].c.value.type.length, 20)
+        assert 'note' in expand.tables['test'].c
+        self.assertEquals(changed, [('test', 'value')])
+
+    @with_database
+    def test_online_index_after_deferred_alter(self):
+
+        engine = self.dbmigrate.engine
+        with _coalesced(engine):
+            # ALTER TABLE deferred as on backends other than SQLite
+            _get_coalescer(engine).defer_alter(
+                'ALTER TABLE test ADD column3 VARCHAR(60)')
+            _execute_autocommit(engine,
+                'CREATE INDEX ix_test_column3 ON test (column3)')
+
+        i = Inspector(engine)
+        assert 'column3' in [c['name'] for c in i.get_columns('test')]
+        self.assertEquals([index['name'] for index in i.get_indexes('test')],
+            ['ix_test_column3'])
+
+    def test_migrate_sql_not_controlled(self):
+
+        self.dbmigrate.init()
+        os.remove(rel('test.sqlite3'))
+
+        self.assertEquals(self.dbmigrate.migrate_plan(), None)
+        assert not self.dbmigrate.migrate_sql('-')
+        self.assertEquals(self.output.getvalue().count('Try to "init" it '
+            'first, or set the starting version with --from'), 2)
+
+        # --from renders without the database
+        assert self.dbmigrate.migrate_sql('-', start=0)
+
+    @with_database_changes
+    def test_migrate_plan(self):
+
+        self.dbmigrate.db = self.app.db
+        self.dbmigrate.schemamigrate(migration_name='added_column2')
+
+        plan = self.dbmigrate.migrate_plan()
+        self.assertEquals([(o['kind'], o['table']) for o in plan],
+            [('metadata', 'test')])
+
+        self.dbmigrate.migrate(upgrade=True, version=None)
+        self.dbmigrate.engine.execute(
+            'INSERT INTO test (column1) VALUES (\'value\')')
+
+        # SQLite drops column by copying the table
+        plan = self.dbmigrate.migrate_plan(version=1, budget=0)
+        rewrites = [o for o in plan if o['kind'] == 'rewrite']
+        self.assertEquals([(o['table'], o['rows']) for o in rewrites],
+            [('test', 1)])
+        assert rewrites[0]['over_budget']
+        assert '1 operation(s) over the 0s budget' in self.output.getvalue()
+
+        # nothing was applied
+        assert self.dbmigrate._get_db_version() == 2
+
+    @with_database_changes
+    def test_migrate_sql(self):
+
+        self.dbmigrate.db = self.app.db
+        self.dbmigrate.schemamigrate(migration_name='added_column2')
+
+        output = os.path.join(self.app.config['SQLALCHEMY_MIGRATE_REPO'],
+            'upgrade.sql')
+
+        manager = Manager(self.app)
+        manager.add_command('dbmigrate', dbmanager)
+
+        sys.argv = ['manage.py', 'dbmigrate', 'migrate', '--sql', output,
+            '--from', '1']
+
+        try:
+            manager.run()
+        except SystemExit, e:
+            self.assertEquals(e.code, 0)
+
+        with open(output) as f:
+            sql = f.read()
+
+        assert 'ALTER TABLE test ADD column2' in sql
+        assert 'SET version=2' in sql
+        assert sql.startswith('BEGIN;')
+
+        # nothing was applied to the database
+        assert self.dbmigrate._get_db_version() == 1
+
+    @with_database_changes
+    def test_squash(self):
+
+        self.dbmigrate.db = self.app.db
+        self.dbmigrate.schemamigrate(migration_name='added_column2')
+        self.dbmigrate._upgrade()
+
+        manager = Manager(self.app)
+        manager.add_command('dbmigrate', dbmanager)
+
+        sys.argv = ['manage.py', 'dbmigrate', 'squash', '--upto', '2']
+
+        try:
+            manager.run()
+        except SystemExit, e:
+            self.assertEquals(e.code, 0)
+
+        repo = self.app.config['SQLALCHEMY_MIGRATE_REPO']
+
+        self.assertEquals(self.dbmigrate._get_migration_scripts(),
+            ['002_baseline.py'])
+        self.assertTrue(os.path.exists(os.path.join(repo,
+            'archive/001_initial.py')))
+        self.assertTrue(os.path.exists(os.path.join(repo,
+            'archive/002_added_column2.py')))
+
+        # existing database keeps working
+        self.dbmigrate.migrate(upgrade=True, version=None)
+        assert self.dbmigrate._get_db_version() == 2
+
+        # brand-new database starts at the baseline
+        os.remove(rel('test.sqlite3'))
+        self.dbmigrate.migrate(upgrade=True, version=None)
+        assert self.dbmigrate._get_db_version() == 2
+
+        i = Inspector(self.dbmigrate.db.engine)
+        assert 'column2' in [c['name'] for c in i.get_columns('test')]
+
+    @with_database_changes
+    def test_squash_database_behind(self):
+
+        self.dbmigrate.db = self.app.db
+        self.dbmigrate.schemamigrate(migration_name='added_column2')
+
+        # database has not reached the version yet
+        self.dbmigrate.squash(2)
+        assert 'Can not squash: database is at version 1' in \
+            self.output.getvalue()
+        self.assertEquals(self.dbmigrate._get_migration_scripts(),
+            ['001_initial.py', '002_added_column2.py'])
+
+        self.dbmigrate._upgrade()
+        self.dbmigrate.squash(2)
+
+        # another database left behind the baseline
+        self.dbmigrate.engine.execute('UPDATE migrate_version SET version = 1')
+        self.dbmigrate._invalidate('controlled_schema')
+        self.assertRaises(MigrationError, self.dbmigrate.migrate,
+            upgrade=True, version=None)
+        assert self.dbmigrate._get_db_version() == 1
+
     @with_database
     def test_migrate_downgrade_to_0(self):
 
@@ -407,6 +1231,65 @@ class DBMigrateRelationshipsTestCase(unittest.TestCase):
         assert 'child' not in Inspector(self.dbmigrate.db.engine
             ).get_table_names()
 
+    def test_schemamigrate_add_indexes(self):
+
+        class Parent(self.app.db.Model):
+            __tablename__ = 'parent'
+            id = self.app.db.Column(self.app.db.Integer,
+                primary_key=True)
+
+        self.dbmigrate = DBMigrate(self.app)
+        self.dbmigrate.init()
+        self.dbmigrate._upgrade()
+
+        self.app.db = SQLAlchemy(self.app)
+
+        class Parent(self.app.db.Model):
+            __tablename__ = 'parent'
+            id = self.app.db.Column(self.app.db.Integer,
+                primary_key=True)
+            children = self.app.db.relationship("Child")
+
+        class Child(self.app.db.Model):
+            __tablename__ = 'child'
+            id = self.app.db.Column(self.app.db.Integer,
+                primary_key=True)
+            parent_id = self.app.db.Column(self.app.db.Integer,
+                self.app.db.ForeignKey('parent.id'))
+
+        self.dbmigrate.db = self.app.db
+        self.dbmigrate.schemamigrate(migration_name='added_child_table',
+            add_indexes=True)
+        self.dbmigrate._upgrade()
+
+        assert 'Advice: Foreign key child (parent_id) has no index' in \
+            self.output.getvalue()
+
+        # suggested index is created together with the table
+        self.assertEquals([i['name'] for i in Inspector(
+            self.dbmigrate.engine).get_indexes('child')],
+            ['ix_child_parent_id'])
+
+        # next migration keeps the suggested index
+        self.dbmigrate.schemamigrate(migration_name='no_changes')
+        assert 'No Changes!' in self.output.getvalue()
+
+        self.app.db.metadata.tables['child'].append_column(
+            self.app.db.Column('name', self.app.db.String(60)))
+        self.dbmigrate.schemamigrate(migration_name='added_name')
+        self.dbmigrate._upgrade()
+
+        self.assertEquals([i['name'] for i in Inspector(
+            self.dbmigrate.engine).get_indexes('child')],
+            ['ix_child_parent_id'])
+
+        # index declared in the models replaces the advisory one
+        Index('ix_child_parent_id', Child.__table__.c.parent_id)
+        self.dbmigrate.schemamigrate(migration_name='declared_index')
+        self.assertEquals(self.dbmigrate._get_migration_scripts(),
+            ['001_initial.py', '002_added_child_table.py',
+                '003_added_name.py'])
+
     def test_many_to_one_relationship(self):
 
         # initial "parent" table
@@ -550,12 +1433,374 @@ class DBMigrateRelationshipsTestCase(unittest.TestCase):
             ).get_table_names()
 
 
+class DBMigrateTemplateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.from_object(TestConfig)
+        self.app.config['SQLALCHEMY_MIGRATE_REPO'] += self.id()
+        self.app.db = SQLAlchemy(self.app)
+        self.Test = make_test_model(self.app.db)
+        self.dbmigrate = DBMigrate(self.app)
+        self.output = StringIO()
+        sys.stdout = self.output
+
+    def tearDown(self):
+        self.dbmigrate.drop_template()
+        self.dbmigrate._drop()
+        self.output.close()
+        if os.path.exists(rel('test.sqlite3')):
+            os.remove(rel('test.sqlite3'))
+
+    @with_template_database
+    def test_template_database(self):
+
+        assert self.dbmigrate._get_db_version() == 1
+
+        table = self.Test.__table__
+        self.app.db.engine.execute(table.insert(), column1='value')
+
+        template = rel('test_template.sqlite3')
+        mtime = os.stat(template).st_mtime
+
+        self.dbmigrate.clone_template()
+
+        # changes made by the test are gone
+        self.assertEquals(self.app.db.engine.execute(
+            table.select()).fetchall(), [])
+
+        # template is not migrated again
+        self.assertEquals(os.stat(template).st_mtime, mtime)
+
+        # state of the template is kept next to it
+        assert os.path.exists(rel('test_template.json'))
+        assert not os.path.exists(os.path.join(
+            self.dbmigrate.sqlalchemy_migration_path, 'template.json'))
+
+    def test_template_database_postgresql(self):
+
+        self.dbmigrate.init()
+        uri = self.dbmigrate.sqlalchemy_database_uri
+        self.dbmigrate.sqlalchemy_database_uri = 'postgresql://localhost/test'
+        statements = []
+
+        def execute_maintenance(*args, **params):
+            statements.append((args, params))
+            return rows
+
+        self.dbmigrate._execute_maintenance = execute_maintenance
+
+        # template database does not exist
+        rows = []
+        assert not self.dbmigrate._is_template_current()
+        self.assertEquals(statements[-1][1], {'name': 'test_template'})
+
+        rows = [(json.dumps(self.dbmigrate._get_template_info()),)]
+        assert self.dbmigrate._is_template_current()
+
+        rows = [(None,)]
+        assert not self.dbmigrate._is_template_current()
+
+        del self.dbmigrate._execute_maintenance
+        self.dbmigrate.sqlalchemy_database_uri = uri
+
+
+class DBMigrateBindsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.from_object(TestConfig)
+        self.app.config['SQLALCHEMY_BINDS'] = {
+            'users': 'sqlite:///' + rel('users.sqlite3')}
+        self.app.db = SQLAlchemy(self.app)
+        self.app.db.Table('test',
+            self.app.db.Column('id', self.app.db.Integer, primary_key=True))
+        self.app.db.Table('users',
+            self.app.db.Column('id', self.app.db.Integer, primary_key=True),
+            info={'bind_key': 'users'})
+        self.dbmigrate = DBMigrate(self.app)
+        self.users = DBMigrate(self.app, 'users')
+        self.output = StringIO()
+        sys.stdout = self.output
+
+    def tearDown(self):
+        self.dbmigrate._drop()
+        self.users._drop()
+        self.output.close()
+        for name in ('test.sqlite3', 'users.sqlite3'):
+            if os.path.exists(rel(name)):
+                os.remove(rel(name))
+
+    def test_init_binds(self):
+
+        self.dbmigrate.init()
+        self.users.init()
+
+        self.assertEquals(self.users.sqlalchemy_migration_path,
+            rel('migrations_users'))
+
+        # every bind gets only its own tables
+        self.assertEquals(Inspector(self.dbmigrate.engine
+            ).get_table_names(), ['migrate_version', 'test'])
+        self.assertEquals(Inspector(self.users.engine
+            ).get_table_names(), ['migrate_version', 'users'])
+        self.assertEquals(self.users._get_schema_snapshot().tables.keys(),
+            ['users'])
+
+    def test_migrate_binds_failure(self):
+
+        self.dbmigrate.init()
+        self.users.init()
+
+        migration = os.path.join(self.users.sqlalchemy_migration_path,
+            'versions/002_broken.py')
+        with open(migration, 'wt') as f:
+            f.write('# __VERSION__: 2\n'
+                'def upgrade(migrate_engine):\n'
+                '    raise RuntimeError("broken")\n')
+
+        manager = Manager(self.app)
+        manager.add_command('dbmigrate', dbmanager)
+
+        sys.argv = ['manage.py', 'dbmigrate', 'migrate']
+
+        try:
+            manager.run()
+        except SystemExit, e:
+            self.assertEquals(e.code, 1)
+
+        output = self.output.getvalue()
+        assert 'default: migrated' in output
+        assert 'users: failed' in output
+
+
+class DBMigrateFleetTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.from_object(TestConfig)
+        self.app.db = SQLAlchemy(self.app)
+        self.Test = make_test_model(self.app.db)
+        self.dbmigrate = DBMigrate(self.app)
+        self.dbmigrate.init()
+        self.targets = rel('targets.txt')
+        self.tenants = [rel('tenant{0}.sqlite3'.format(i)) for i in range(3)]
+        with open(self.targets, 'wt') as f:
+            for tenant in self.tenants:
+                f.write('sqlite:///{0}\n'.format(tenant))
+            # schema targets are not supported by SQLite
+            f.write('tenant\n')
+        self.output = StringIO()
+        sys.stdout = self.output
+
+    def tearDown(self):
+        self.dbmigrate._drop()
+        self.output.close()
+        for path in self.tenants + [self.targets, self.targets + '.done',
+            rel('test.sqlite3')]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_migrate_targets(self):
+
+        manager = Manager(self.app)
+        manager.add_command('dbmigrate', dbmanager)
+
+        sys.argv = ['manage.py', 'dbmigrate', 'migrate', '--targets',
+            self.targets, '--workers', '2']
+
+        try:
+            manager.run()
+        except SystemExit, e:
+            self.assertEquals(e.code, 1)
+
+        for tenant in self.tenants:
+            engine = create_engine('sqlite:///' + tenant)
+            self.assertEquals(engine.execute(
+                'SELECT version FROM migrate_version').scalar(), 1)
+
+        output = self.output.getvalue()
+        assert 'tenant: failed' in output
+        assert 'Migrated 3 of 4 targets' in output
+
+        # migrated targets are skipped when the run is repeated
+        sys.argv = ['manage.py', 'dbmigrate', 'migrate', '--targets',
+            self.targets]
+
+        try:
+            manager.run()
+        except SystemExit, e:
+            self.assertEquals(e.code, 1)
+
+        assert 'Migrated 0 of 4 targets' in self.output.getvalue()
+        assert '3 skipped, 1 failed' in self.output.getvalue()
+
+
+class BackfillTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite:///' + rel('test.sqlite3'))
+        self.table = Table('test', MetaData(),
+            Column('id', Integer, primary_key=True),
+            Column('value', Integer))
+        self.table.create(bind=self.engine)
+        self.engine.execute(self.table.insert(),
+            [{'id': i, 'value': None} for i in range(1, 26)])
+        self.output = StringIO()
+        sys.stdout = self.output
+
+    def tearDown(self):
+        self.output.close()
+        if os.path.exists(rel('test.sqlite3')):
+            os.remove(rel('test.sqlite3'))
+
+    def test_backfill(self):
+
+        rows = backfill(self.engine, self.table, {'value': 1},
+            where=self.table.c.value == None, batch_size=10)
+
+        self.assertEquals(rows, 25)
+        self.assertEquals(self.engine.execute(self.table.select(
+            self.table.c.value == None)).fetchall(), [])
+
+        # one line per batch
+        self.assertEquals(len(self.output.getvalue().splitlines()), 3)
+
+        # checkpoint is removed after backfill is done
+        self.assertEquals(self.engine.execute(
+            'SELECT COUNT(*) FROM migrate_backfill').scalar(), 0)
+
+    def test_backfill_resume(self):
+
+        batches = []
+
+        def update(connection, first, last):
+            if len(batches) == 1:
+                raise RuntimeError('interrupted')
+            batches.append((first, last))
+            return last - first + 1
+
+        self.assertRaises(RuntimeError, backfill, self.engine, self.table,
+            update, batch_size=10)
+
+        self.assertEquals(batches, [(1, 10)])
+
+        batches.append(None)
+        backfill(self.engine, self.table, update, batch_size=10)
+
+        # backfill resumes after the last checkpoint
+        self.assertEquals(batches, [(1, 10), None, (11, 20), (21, 25)])
+
+    def test_alter_table_online(self):
+
+        table = Table('test', MetaData(),
+            Column('id', Integer, primary_key=True),
+            Column('value', String(20)),
+            Column('note', String(20)))
+        Index('ix_test_value', table.c.value)
+        # index of the old table with the same name
+        Index('ix_test_value', self.table.c.value).create(bind=self.engine)
+
+        def write():
+            # concurrent writes while rows are copied
+            time.sleep(0.05)
+            self.engine.execute('UPDATE test SET value = 7 WHERE id = 1')
+            self.engine.execute('DELETE FROM test WHERE id = 2')
+            self.engine.execute('INSERT INTO test (id, value) VALUES (26, 8)')
+
+        statements = []
+
+        def record(conn, cursor, statement, parameters, *args):
+            statements.append(statement.strip())
+            return statement, parameters
+
+        event.listen(self.engine, 'before_cursor_execute', record,
+            retval=True)
+        writer = threading.Thread(target=write)
+        writer.start()
+        try:
+            rows = alter_table_online(self.engine, table, batch_size=5,
+                sleep=0.02)
+        finally:
+            writer.join()
+            self.engine.dispatch.before_cursor_execute.remove(record,
+                self.engine)
+
+        # index is built in the swap transaction
+        self.assertEquals(statements[statements.index(
+            'CREATE INDEX ix_test_value ON test (value)') + 1], 'COMMIT')
+
+        assert rows >= 24
+        assert re.match(r'Copied \d+ rows of test in [0-9.]+s \(\d+ rows/s\)',
+            self.output.getvalue())
+
+        i = Inspector(self.engine)
+        self.assertEquals(sorted(i.get_table_names()), ['test'])
+        columns = dict((c['name'], c) for c in i.get_columns('test'))
+        self.assertEquals(sorted(columns), ['id', 'note', 'value'])
+        self.assertEquals(str(columns['value']['type']), 'VARCHAR(20)')
+        self.assertEquals([index['name'] for index in i.get_indexes('test')],
+            ['ix_test_value'])
+
+        result = self.engine.execute('SELECT id, value FROM test '
+            'ORDER BY id').fetchall()
+        self.assertEquals(result[:2], [(1, '7'), (3, None)])
+        self.assertEquals(result[-1], (26, '8'))
+        self.assertEquals(len(result), 25)
+
+    def test_alter_table_online_interrupted(self):
+
+        table = Table('test', MetaData(),
+            Column('id', Integer, primary_key=True),
+            Column('value', String(20)))
+
+        def interrupt(conn, cursor, statement, parameters, *args):
+            if statement.startswith('INSERT OR IGNORE INTO'):
+                raise KeyboardInterrupt()
+            return statement, parameters
+
+        event.listen(self.engine, 'before_cursor_execute', interrupt,
+            retval=True)
+        try:
+            self.assertRaises(KeyboardInterrupt, alter_table_online,
+                self.engine, table)
+        finally:
+            self.engine.dispatch.before_cursor_execute.remove(interrupt,
+                self.engine)
+
+        # triggers and shadow table of the interrupted change are replaced
+        self.assertEquals(alter_table_online(self.engine, table), 25)
+        self.assertEquals(self.engine.execute('SELECT name FROM sqlite_master '
+            'WHERE type = \'trigger\'').fetchall(), [])
+
+    def test_alter_table_online_referenced(self):
+
+        Table('child', self.table.metadata,
+            Column('id', Integer, primary_key=True),
+            Column('test_id', Integer, ForeignKey('test.id'))).create(
+                bind=self.engine)
+
+        table = Table('test', MetaData(),
+            Column('id', Integer, primary_key=True),
+            Column('value', String(20)))
+
+        self.assertRaises(ValueError, alter_table_online, self.engine, table)
+
+        # shadow table is not created
+        self.assertEquals(sorted(Inspector(self.engine).get_table_names()),
+            ['child', 'test'])
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(DBMigrateInitTestCase))
     suite.addTest(unittest.makeSuite(DBMigrateSubManagerTestCase))
     suite.addTest(unittest.makeSuite(DBMigrateCommandsTestCase))
     suite.addTest(unittest.makeSuite(DBMigrateRelationshipsTestCase))
+    suite.addTest(unittest.makeSuite(DBMigrateTemplateTestCase))
+    suite.addTest(unittest.makeSuite(DBMigrateBindsTestCase))
+    suite.addTest(unittest.makeSuite(DBMigrateFleetTestCase))
+    suite.addTest(unittest.makeSuite(BackfillTestCase))
     return suite
 
 if __name__ == '__main__':